@@ -1,8 +1,15 @@
 import os
 import sys
-from typing import Optional
-from openai import AzureOpenAI
-from dotenv import load_dotenv
+import time
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from answer_cache import AnswerCache
+from agent_tools import KousuTools
+from analytics import KousuAnalytics
+from context_builder import PromptContextBuilder, estimate_tokens, period_label
+from metrics import llm_request_duration, llm_tokens
 
 # UTF-8エンコーディングを強制（Windows環境のみ）
 if sys.platform == 'win32':
@@ -13,121 +20,271 @@ if sys.platform == 'win32':
     except Exception:
         pass  # Azure App Service等のLinux環境では不要
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 class KousuAgent:
-    def __init__(self, database):
+    ANSWER_GUIDELINES = """回答の際は、以下の点に注意してください：
+1. 見やすさのため、適切に改行を入れてください
+2. 箇条書きや段落分けを活用してください
+3. 数値データを提示する際は表形式や箇条書きにしてください
+4. 重要なポイントは太字(**テキスト**)や見出しで強調してください"""
+
+    SYSTEM_PROMPT = """あなたは工数管理の専門家です。以下の工数データを基に、ユーザーの質問に答えてください。
+
+""" + ANSWER_GUIDELINES
+
+    TOOL_SYSTEM_PROMPT = """あなたは工数管理の専門家です。工数データはツールで取得できます。質問に答えるために必要なデータだけをツールで取得し、その結果を基にユーザーの質問に答えてください。
+
+データの取得について：
+- 期間は from/to（YYYY-MM）で指定してください。質問に期間がない場合は、画面で選択中の期間を使ってください
+- まず集計（get_summary、get_analytics、get_top_variance 等）で全体を把握し、明細（get_records）は必要な場合だけ取得してください
+- ツールの結果にない数値を推測で答えないでください
+
+""" + ANSWER_GUIDELINES
+
+    DISABLED_MESSAGE = "エージェント機能を使用するには、.envファイルにAzure OpenAIの設定を行ってください。"
+
+    def __init__(self, database, client=None, analytics=None):
         self.db = database
-        endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
-        api_key = os.getenv('AZURE_OPENAI_API_KEY')
+        # 差分・精度・前月比は /api/analytics と同じ計算結果を使う
+        self.analytics = analytics or KousuAnalytics(database)
+        self.context_builder = PromptContextBuilder(database, self.analytics)
+        self.answer_cache = AnswerCache()
+        # ツール呼び出しで必要なデータだけを取得する（0で従来通りプロンプトに工数データを含める）
+        self.tools = KousuTools(database, self.analytics) if os.getenv('KOUSU_AGENT_TOOLS', '1') != '0' else None
+        self.endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
+        self.api_key = os.getenv('AZURE_OPENAI_API_KEY')
         deployment = os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME')
-        api_version = os.getenv('AZURE_OPENAI_API_VERSION', '2024-02-15-preview')
-
-        if endpoint and api_key and deployment:
-            self.client = AzureOpenAI(
-                azure_endpoint=endpoint,
-                api_key=api_key,
-                api_version=api_version
-            )
+        self.api_version = os.getenv('AZURE_OPENAI_API_VERSION', '2024-02-15-preview')
+        # OpenAI互換エンドポイント（ローカルのスタブサーバー等）を使う場合
+        self.base_url = os.getenv('KOUSU_AGENT_BASE_URL')
+        # API呼び出しのタイムアウト（秒）。ジョブのタイムアウトより短くしてスレッドを解放する
+        self.request_timeout = float(os.getenv('KOUSU_AGENT_TIMEOUT', '100'))
+
+        if client is not None or self.base_url:
+            self.deployment_name = os.getenv('KOUSU_AGENT_MODEL', deployment or 'stub')
+            self.enabled = True
+        elif self.endpoint and self.api_key and deployment:
             self.deployment_name = deployment
             self.enabled = True
         else:
-            self.client = None
             self.deployment_name = None
             self.enabled = False
 
-    def chat(self, message: str, year: Optional[int] = None, month: Optional[int] = None) -> str:
+        # 呼び出し側で用意したクライアント（スクリプトで応答するスタブ等）はそのまま使う
+        self._given_client = client
+        # クライアントは初回の呼び出し時に作成（起動時にopenaiを読み込まない・fork前に接続を作らない）
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
         if not self.enabled:
-            return "エージェント機能を使用するには、.envファイルにAzure OpenAIの設定を行ってください。"
+            return None
+        if self._given_client is not None:
+            return self._given_client
+        if self._client is None or self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = self._create_client()
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def _create_client(self):
+        from openai import AzureOpenAI, OpenAI
 
-        kousu_data = self.db.get_summary_by_period(year, month)
+        if self.base_url:
+            return OpenAI(base_url=self.base_url, api_key=os.getenv('KOUSU_AGENT_API_KEY', 'dummy'),
+                          timeout=self.request_timeout)
+        return AzureOpenAI(
+            azure_endpoint=self.endpoint,
+            api_key=self.api_key,
+            api_version=self.api_version,
+            timeout=self.request_timeout
+        )
 
-        period_str = "全期間"
+    def _build_messages(self, message: str, year: Optional[int], month: Optional[int]) -> List[dict]:
+        if self.tools is not None:
+            # データはモデルがツールで取得する（プロンプトには期間と質問だけを含める）
+            user_content = f"【画面で選択中の期間】: {self._period_hint(year, month)}\n【ユーザーの質問】: {message}"
+            return [
+                {"role": "system", "content": self.TOOL_SYSTEM_PROMPT},
+                {"role": "user", "content": user_content}
+            ]
+
+        # 工数データ（トークン予算を超える場合は集計表に切り替え、データバージョン単位でキャッシュ）
+        user_content = self.context_builder.build(year, month)
+        user_content += f"\n【ユーザーの質問】: {message}"
+        return [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": user_content}
+        ]
+
+    @staticmethod
+    def _period_hint(year: Optional[int], month: Optional[int]) -> str:
         if year and month:
-            period_str = f"{year}年{month}月"
+            return f"{period_label(year, month)}（from={year}-{month:02d}, to={year}-{month:02d}）"
         elif year:
-            period_str = f"{year}年"
+            return f"{period_label(year, month)}（from={year}-01, to={year}-12）"
+        return f"{period_label(year, month)}（from/to の指定なし）"
 
-        system_prompt = """あなたは工数管理の専門家です。以下の工数データを基に、ユーザーの質問に答えてください。
+    def _max_rounds(self) -> int:
+        return self.tools.max_rounds if self.tools is not None else 0
 
-回答の際は、以下の点に注意してください：
-1. 見やすさのため、適切に改行を入れてください
-2. 箇条書きや段落分けを活用してください
-3. 数値データを提示する際は表形式や箇条書きにしてください
-4. 重要なポイントは太字(**テキスト**)や見出しで強調してください"""
+    def _completion_args(self, messages: List[dict], round_number: int, deadline: Optional[float] = None) -> dict:
+        args = {'model': self.deployment_name, 'messages': messages, 'max_completion_tokens': 4000}
+        if deadline is not None:
+            # 全体の期限（time.time()）までの残り時間をこの呼び出しのタイムアウトにする
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("エージェントの応答が期限内に完了しませんでした")
+            args['timeout'] = min(self.request_timeout, remaining)
+        if self.tools is not None:
+            args['tools'] = self.tools.definitions
+            # 往復回数の上限に達したら、取得済みのデータで回答させる
+            args['tool_choice'] = 'auto' if round_number < self.tools.max_rounds else 'none'
+        return args
 
-        user_content = f"""
-【対象期間】: {period_str}
-
-【工数サマリー】:
-- 見積工数合計: {kousu_data['total_estimated']:.1f}時間
-- 予定工数合計: {kousu_data['total_planned']:.1f}時間
-- 実績工数合計: {kousu_data['total_actual']:.1f}時間
-- 案件・レコード数: {kousu_data['record_count']}件
-
-【詳細データ】:
-"""
-        for record in kousu_data['records']:
-            user_content += f"\n案件: {record['project_name']}"
-            if record['client']:
-                user_content += f" (クライアント: {record['client']})"
-            user_content += f"\n  期間: {record['year']}年{record['month']}月"
-
-            # メンバー情報を追加
-            if record.get('member_name'):
-                user_content += f"\n  担当者: {record['member_name']}"
-            else:
-                user_content += f"\n  担当者: 未割当（案件全体）"
-
-            user_content += f"\n  見積工数: {record['estimated_hours']:.1f}h"
-            user_content += f"\n  予定工数: {record['planned_hours']:.1f}h"
-            user_content += f"\n  実績工数: {record['actual_hours']:.1f}h"
-
-            # 差分情報も追加
-            estimated_diff = record['actual_hours'] - record['estimated_hours']
-            planned_diff = record['actual_hours'] - record['planned_hours']
-            user_content += f"\n  見積差分: {estimated_diff:+.1f}h"
-            user_content += f"\n  予定差分: {planned_diff:+.1f}h"
-
-            if record['notes']:
-                user_content += f"\n  備考: {record['notes']}"
-            user_content += "\n"
+    def _append_tool_results(self, messages: List[dict], content: Optional[str], tool_calls: List[dict]):
+        """アシスタントのツール呼び出しとその実行結果を会話に追加"""
+        logger.debug("Agent tool calls: %s", [(c['name'], c['arguments']) for c in tool_calls])
+        messages.append({"role": "assistant", "content": content, "tool_calls": [
+            {"id": c['id'], "type": "function", "function": {"name": c['name'], "arguments": c['arguments']}}
+            for c in tool_calls
+        ]})
+        messages.extend(self.tools.run_calls(tool_calls))
 
-        user_content += f"\n【ユーザーの質問】: {message}"
+    def chat(self, message: str, year: Optional[int] = None, month: Optional[int] = None,
+             deadline: Optional[float] = None) -> str:
+        """回答を返す。deadline（time.time()）を過ぎたらツールの往復を含めて打ち切り、TimeoutError を送出する"""
+        if not self.enabled:
+            return self.DISABLED_MESSAGE
+
+        # 同じ質問・期間・データバージョンの回答があればそれを返す
+        version = self.db.get_data_version()
+        cached = self.answer_cache.get(message, year, month, version)
+        if cached is not None:
+            return cached
+
+        messages = self._build_messages(message, year, month)
+        max_rounds = self._max_rounds()
 
         try:
-            print(f"[DEBUG] Calling Azure OpenAI with model: {self.deployment_name}")
-            print(f"[DEBUG] API Version: {self.client._api_version}")
-
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
-                max_completion_tokens=4000
-            )
-
-            print(f"[DEBUG] Response received")
-            print(f"[DEBUG] Response.choices: {response.choices}")
-            print(f"[DEBUG] First choice: {response.choices[0]}")
-            print(f"[DEBUG] Message: {response.choices[0].message}")
-            print(f"[DEBUG] Message.content: {repr(response.choices[0].message.content)}")
-
-            result = response.choices[0].message.content
-            print(f"[DEBUG] Result assigned, length: {len(result) if result else 0}")
-            print(f"[DEBUG] Result type: {type(result)}")
-            print(f"[DEBUG] Result repr: {repr(result[:100]) if result else 'None'}")
+            for round_number in range(max_rounds + 1):
+                logger.debug("Calling LLM: model=%s round=%d", self.deployment_name, round_number)
+                start = time.perf_counter()
+
+                response = self.client.chat.completions.create(
+                    **self._completion_args(messages, round_number, deadline))
+
+                elapsed = time.perf_counter() - start
+                llm_request_duration.observe(elapsed, mode='chat')
+                reply = response.choices[0].message
+                result = reply.content
+                self._record_usage(getattr(response, 'usage', None), messages, result)
+                logger.debug("LLM response received in %.2fs, length=%d", elapsed, len(result) if result else 0)
+
+                tool_calls = [{'id': c.id, 'name': c.function.name, 'arguments': c.function.arguments}
+                              for c in getattr(reply, 'tool_calls', None) or ()]
+                if not tool_calls or round_number == max_rounds:
+                    break
+                self._append_tool_results(messages, result, tool_calls)
 
             if not result or len(result.strip()) == 0:
-                print("[ERROR] Empty response from API")
+                logger.error("Empty response from LLM")
                 return "応答が空でした。もう一度お試しください。"
 
-            print(f"[DEBUG] Returning result of length {len(result)}")
+            self.answer_cache.put(message, year, month, version, result)
             return result
 
+        except TimeoutError:
+            # 期限切れはモデルの失敗と区別できるよう呼び出し側に送出する（chat_stream と同じ）
+            raise
         except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            print(f"[ERROR] {error_details}")
+            logger.exception("LLM request failed")
             return f"エラーが発生しました: {str(e)}"
+
+    @staticmethod
+    def _record_usage(usage, messages: List[dict], result: Optional[str]):
+        """トークン使用量を記録（APIが返さない場合は概算）"""
+        if usage is not None and getattr(usage, 'prompt_tokens', None) is not None:
+            llm_tokens.inc(usage.prompt_tokens, type='prompt', source='api')
+            llm_tokens.inc(usage.completion_tokens or 0, type='completion', source='api')
+        else:
+            prompt = ''.join(m.get('content') or '' for m in messages)
+            llm_tokens.inc(estimate_tokens(prompt), type='prompt', source='estimated')
+            llm_tokens.inc(estimate_tokens(result or ''), type='completion', source='estimated')
+
+    @staticmethod
+    def _merge_tool_call_deltas(calls: Dict[int, dict], deltas):
+        """ストリーミングで分割されて届くツール呼び出し（index単位）を組み立てる"""
+        for delta in deltas:
+            call = calls.setdefault(delta.index, {'id': None, 'name': '', 'arguments': ''})
+            if delta.id:
+                call['id'] = delta.id
+            function = delta.function
+            if function is not None:
+                call['name'] += function.name or ''
+                call['arguments'] += function.arguments or ''
+
+    def chat_stream(self, message: str, year: Optional[int] = None, month: Optional[int] = None,
+                    deadline: Optional[float] = None) -> Iterator[str]:
+        """回答をトークン単位で返すジェネレーター（API呼び出しの失敗は例外として送出）
+
+        deadline（time.time()）を過ぎたら TimeoutError を送出して打ち切る。
+        """
+        if not self.enabled:
+            yield self.DISABLED_MESSAGE
+            return
+
+        version = self.db.get_data_version()
+        cached = self.answer_cache.get(message, year, month, version)
+        if cached is not None:
+            yield cached
+            return
+
+        messages = self._build_messages(message, year, month)
+        max_rounds = self._max_rounds()
+        parts = []
+        for round_number in range(max_rounds + 1):
+            logger.debug("Calling LLM (stream): model=%s round=%d", self.deployment_name, round_number)
+            start = time.perf_counter()
+            stream = self.client.chat.completions.create(
+                stream=True, **self._completion_args(messages, round_number, deadline))
+
+            round_parts = []
+            tool_calls: Dict[int, dict] = {}
+            usage = None
+            try:
+                for chunk in stream:
+                    if getattr(chunk, 'usage', None) is not None:
+                        usage = chunk.usage
+                    # Azureはコンテンツフィルター結果のみのチャンク（choicesが空）を返すことがある
+                    if not chunk.choices:
+                        continue
+                    if deadline is not None and time.time() > deadline:
+                        raise TimeoutError("エージェントの応答が期限内に完了しませんでした")
+                    delta = chunk.choices[0].delta
+                    if getattr(delta, 'tool_calls', None):
+                        self._merge_tool_call_deltas(tool_calls, delta.tool_calls)
+                    text = delta.content
+                    if text:
+                        round_parts.append(text)
+                        parts.append(text)
+                        yield text
+            finally:
+                stream.close()
+                llm_request_duration.observe(time.perf_counter() - start, mode='stream')
+
+            self._record_usage(usage, messages, ''.join(round_parts))
+            if not tool_calls or round_number == max_rounds:
+                break
+            self._append_tool_results(messages, ''.join(round_parts) or None,
+                                      [tool_calls[i] for i in sorted(tool_calls)])
+
+        result = ''.join(parts)
+        if not result.strip():
+            yield "応答が空でした。もう一度お試しください。"
+            return
+        self.answer_cache.put(message, year, month, version, result)
@@ -0,0 +1,307 @@
+import json
+import logging
+import os
+from itertools import islice
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from context_builder import estimate_tokens
+from database import parse_period
+from metrics import agent_tool_calls
+
+logger = logging.getLogger(__name__)
+
+# 期間の引数（各ツール共通）
+PERIOD_PROPERTIES = {
+    'from': {'type': 'string', 'description': '開始年月（YYYY-MM、この月を含む）。省略時は制限なし'},
+    'to': {'type': 'string', 'description': '終了年月（YYYY-MM、この月を含む）。省略時は制限なし'},
+}
+
+LIMIT_PROPERTY = {'type': 'integer', 'description': '取得する最大件数', 'minimum': 1}
+
+
+def _function(name: str, description: str, properties: Dict, required: Tuple[str, ...] = ()) -> Dict:
+    return {
+        'type': 'function',
+        'function': {
+            'name': name,
+            'description': description,
+            'parameters': {'type': 'object', 'properties': properties, 'required': list(required)},
+        },
+    }
+
+
+class KousuTools:
+    """エージェントが呼び出すツール（function calling）。Databaseの読み取りメソッドを実行して結果をJSONで返す
+
+    プロンプトに全データを載せる代わりに、モデルが質問に必要な分だけを取得する。
+    1回の結果は件数（max_rows）とトークン数（result_tokens）で打ち切る。
+    """
+
+    # get_analytics で返す全体の月次推移の月数（直近から）
+    RECENT_MONTHS = 12
+
+    def __init__(self, database, analytics, max_rounds: Optional[int] = None, max_calls: Optional[int] = None,
+                 max_rows: Optional[int] = None, result_tokens: Optional[int] = None):
+        self.db = database
+        self.analytics = analytics
+        # ツール呼び出しの往復回数の上限（超えたらツールなしで回答させる）
+        self.max_rounds = max_rounds if max_rounds is not None else int(os.getenv('KOUSU_AGENT_TOOL_ROUNDS', '4'))
+        # 1往復で実行するツール呼び出しの上限
+        self.max_calls = max_calls or int(os.getenv('KOUSU_AGENT_TOOL_CALLS', '8'))
+        self.max_rows = max_rows or int(os.getenv('KOUSU_AGENT_TOOL_MAX_ROWS', '50'))
+        self.result_tokens = result_tokens or int(os.getenv('KOUSU_AGENT_TOOL_RESULT_TOKENS', '1500'))
+
+        self.handlers: Dict[str, Callable[[Dict], Any]] = {
+            'list_periods': self.list_periods,
+            'get_summary': self.get_summary,
+            'get_project_totals': self.get_project_totals,
+            'get_member_monthly': self.get_member_monthly,
+            'get_records': self.get_records,
+            'get_analytics': self.get_analytics,
+            'get_top_variance': self.get_top_variance,
+            'search_records': self.search_records,
+        }
+        self.definitions = [
+            _function('list_periods', '工数データが登録されている年月の一覧（新しい順）', {}),
+            _function('get_summary', '期間の見積・予定・実績工数の合計とレコード数', dict(PERIOD_PROPERTIES)),
+            _function('get_project_totals', '案件別の期間合計工数（実績の大きい順）', {
+                **PERIOD_PROPERTIES,
+                'project': {'type': 'string', 'description': '案件名またはクライアント名に含まれる文字列'},
+                'limit': LIMIT_PROPERTY,
+            }),
+            _function('get_member_monthly', 'メンバー別・月別の工数と担当案件（新しい月順）', {
+                **PERIOD_PROPERTIES,
+                'member': {'type': 'string', 'description': 'メンバー名に含まれる文字列'},
+                'limit': LIMIT_PROPERTY,
+            }),
+            _function('get_records', '工数レコードの明細（案件・メンバー・年月ごと、新しい月順）', {
+                **PERIOD_PROPERTIES,
+                'project': {'type': 'string', 'description': '案件名に含まれる文字列'},
+                'member': {'type': 'string', 'description': 'メンバー名に含まれる文字列'},
+                'limit': LIMIT_PROPERTY,
+            }),
+            _function('get_analytics', '案件別・メンバー別の見積精度（実績/見積）・差分・直近の前月比（差分の大きい順）と、'
+                      '全体の月次推移（累積の消化率・前月比）', {
+                **PERIOD_PROPERTIES,
+                'group_by': {'type': 'string', 'enum': ['project', 'member'], 'description': '集計単位'},
+                'limit': LIMIT_PROPERTY,
+            }),
+            _function('get_top_variance', '実績と見積（または予定）の差分が大きい案件・メンバーの上位N件', {
+                **PERIOD_PROPERTIES,
+                'group_by': {'type': 'string', 'enum': ['project', 'member'], 'description': '集計単位'},
+                'basis': {'type': 'string', 'enum': ['estimated', 'planned'],
+                          'description': '比較対象（estimated=見積、planned=予定）'},
+                'direction': {'type': 'string', 'enum': ['over', 'under', 'abs'],
+                              'description': 'over=超過の大きい順、under=不足の大きい順、abs=差の絶対値順'},
+                'limit': LIMIT_PROPERTY,
+            }),
+            _function('search_records', '案件名・クライアント・説明・メンバー名・備考の全文検索（一致度順）。'
+                      '工数レコードのほか、一致した案件・メンバー（kind=project/member）も返す（期間指定時は工数レコードのみ）', {
+                **PERIOD_PROPERTIES,
+                'query': {'type': 'string', 'description': '検索語（空白区切りでAND）'},
+                'limit': LIMIT_PROPERTY,
+            }, required=('query',)),
+        ]
+
+    # ツール呼び出しの実行
+    def run(self, name: str, arguments: str) -> str:
+        """ツールを実行して結果のJSON文字列を返す（引数の誤り等はエラーとしてモデルに返す）"""
+        handler = self.handlers.get(name)
+        if handler is None:
+            agent_tool_calls.inc(tool='unknown', status='error')
+            return self._dump({'error': f'不明なツールです: {name}'})
+        try:
+            args = json.loads(arguments) if arguments else {}
+            if not isinstance(args, dict):
+                raise ValueError('引数はオブジェクトで指定してください')
+            result = handler(args)
+        except (ValueError, KeyError, TypeError) as e:
+            agent_tool_calls.inc(tool=name, status='error')
+            logger.info("Agent tool %s rejected arguments %s: %s", name, arguments, e)
+            return self._dump({'error': str(e)})
+        agent_tool_calls.inc(tool=name, status='ok')
+        return self._render(result)
+
+    def run_calls(self, tool_calls: List[Dict]) -> List[Dict]:
+        """アシスタントのtool_calls（{'id', 'name', 'arguments'}）を実行し、toolロールのメッセージを返す"""
+        messages = []
+        for i, call in enumerate(tool_calls):
+            if i < self.max_calls:
+                content = self.run(call['name'], call['arguments'])
+            else:
+                agent_tool_calls.inc(tool=call['name'], status='skipped')
+                content = self._dump({'error': f'1回に実行できるツールは{self.max_calls}件までです'})
+            messages.append({'role': 'tool', 'tool_call_id': call['id'], 'content': content})
+        return messages
+
+    @staticmethod
+    def _dump(value) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+    def _render(self, result) -> str:
+        """結果をJSONにする。rows がトークン予算を超える場合は先頭から収まる分だけ返す"""
+        rows = result.pop('rows', None) if isinstance(result, dict) else None
+        if rows is None:
+            return self._dump(result)
+
+        budget = self.result_tokens - estimate_tokens(self._dump(result))
+        kept = []
+        used = 0
+        for row in rows:
+            used += estimate_tokens(self._dump(row)) + 1
+            if used > budget:
+                break
+            kept.append(row)
+        if len(kept) < len(rows):
+            result['truncated'] = True
+            result['note'] = f'結果が多いため{len(rows)}件中{len(kept)}件のみ返しています。期間や条件を絞ってください'
+        result['rows'] = kept
+        return self._dump(result)
+
+    def _limit(self, args: Dict) -> int:
+        limit = int(args.get('limit') or self.max_rows)
+        if limit < 1:
+            raise ValueError('limitは1以上を指定してください')
+        return min(limit, self.max_rows)
+
+    @staticmethod
+    def _period(args: Dict) -> Dict:
+        return {'period_from': parse_period(args.get('from'), 'from'),
+                'period_to': parse_period(args.get('to'), 'to')}
+
+    @staticmethod
+    def _hours(row: Dict) -> Dict:
+        return {
+            'estimated_hours': round(row['estimated_hours'], 1),
+            'planned_hours': round(row['planned_hours'], 1),
+            'actual_hours': round(row['actual_hours'], 1),
+        }
+
+    @staticmethod
+    def _round(value: Optional[float], digits: int = 1) -> Optional[float]:
+        return None if value is None else round(value, digits)
+
+    @staticmethod
+    def _contains(value: Optional[str], text: Optional[str]) -> bool:
+        return not text or text.lower() in (value or '').lower()
+
+    # 各ツール
+    def list_periods(self, args: Dict) -> Dict:
+        periods = self.db.get_all_years_months()
+        return {'rows': [f"{p['year']}-{p['month']:02d}" for p in periods]}
+
+    def get_summary(self, args: Dict) -> Dict:
+        summary = self.db.get_summary_by_period(include_records=False, **self._period(args))
+        return {
+            'estimated_hours': round(summary['total_estimated'], 1),
+            'planned_hours': round(summary['total_planned'], 1),
+            'actual_hours': round(summary['total_actual'], 1),
+            'record_count': summary['record_count'],
+        }
+
+    def get_project_totals(self, args: Dict) -> Dict:
+        project = args.get('project')
+        rows = [r for r in self.db.get_kousu_by_project(**self._period(args))
+                if self._contains(r['project_name'], project) or self._contains(r['client'], project)]
+        rows.sort(key=lambda r: r['actual_hours'], reverse=True)
+        return {'total_rows': len(rows), 'rows': [
+            {'project': r['project_name'], 'client': r['client'] or None, **self._hours(r),
+             'members': r['members']}
+            for r in rows[:self._limit(args)]
+        ]}
+
+    def get_member_monthly(self, args: Dict) -> Dict:
+        member = args.get('member')
+        rows = [r for r in self.db.get_kousu_by_member(**self._period(args))
+                if self._contains(r['member_name'], member)]
+        return {'total_rows': len(rows), 'rows': [
+            {'member': r['member_name'] or '未割当', 'period': f"{r['year']}-{r['month']:02d}",
+             **self._hours(r), 'projects': r['projects']}
+            for r in rows[:self._limit(args)]
+        ]}
+
+    def get_records(self, args: Dict) -> Dict:
+        project, member = args.get('project'), args.get('member')
+        records = (r for r in self.db.iter_kousu_by_period(**self._period(args))
+                   if self._contains(r['project_name'], project) and self._contains(r['member_name'], member))
+        # 上限+1件まで読んで打ち切る（残りがあることだけを伝える）
+        limit = self._limit(args)
+        rows = list(islice(records, limit + 1))
+        result = {'rows': [
+            {'project': r['project_name'], 'member': r['member_name'] or '未割当',
+             'period': f"{r['year']}-{r['month']:02d}", **self._hours(r), 'notes': r['notes'] or None}
+            for r in rows[:limit]
+        ]}
+        if len(rows) > limit:
+            result['has_more'] = True
+        return result
+
+    def get_analytics(self, args: Dict) -> Dict:
+        group_by = args.get('group_by') or 'project'
+        if group_by not in ('project', 'member'):
+            raise ValueError('group_byはprojectまたはmemberを指定してください')
+        result = self.analytics.get(group_by, **self._period(args))
+        totals = result['totals']
+        if totals is None:
+            return {'totals': None, 'rows': []}
+
+        def ratios(row: Dict, *keys: str) -> Dict:
+            return {key: self._round(row[key], 3) for key in keys}
+
+        months = result['months']
+        return {
+            'totals': {**self._hours(totals), 'estimate_variance': self._round(totals['estimate_variance']),
+                       'plan_variance': self._round(totals['plan_variance']),
+                       **ratios(totals, 'estimate_accuracy', 'plan_accuracy')},
+            'recent_months': [
+                {'month': m['month'], 'actual_hours': self._round(m['actual_hours']),
+                 'cumulative_actual': self._round(m['cumulative_actual']),
+                 'mom_change': self._round(m['mom_change']), **ratios(m, 'estimate_accuracy', 'burn_rate')}
+                for m in months[-self.RECENT_MONTHS:]
+            ],
+            'total_rows': len(result['items']),
+            'rows': [
+                {group_by: item['name'], **self._hours(item),
+                 'estimate_variance': self._round(item['estimate_variance']),
+                 'plan_variance': self._round(item['plan_variance']),
+                 **ratios(item, 'estimate_accuracy', 'plan_accuracy'),
+                 'last_month': item['last_month']['month'],
+                 'last_month_mom_change': self._round(item['last_month']['mom_change'])}
+                for item in result['items'][:self._limit(args)]
+            ],
+        }
+
+    def get_top_variance(self, args: Dict) -> Dict:
+        group_by = args.get('group_by') or 'project'
+        basis = args.get('basis') or 'estimated'
+        direction = args.get('direction') or 'abs'
+        if group_by not in ('project', 'member'):
+            raise ValueError('group_byはprojectまたはmemberを指定してください')
+        if basis not in self.db.VARIANCE_BASES:
+            raise ValueError('basisはestimatedまたはplannedを指定してください')
+        if direction not in ('over', 'under', 'abs'):
+            raise ValueError('directionはover・under・absのいずれかを指定してください')
+        rows = self.db.get_top_variance(group_by, basis, direction, self._limit(args), **self._period(args))
+        name_key = 'project_name' if group_by == 'project' else 'member_name'
+        return {'basis': basis, 'rows': [
+            {group_by: r[name_key] or '未割当', **self._hours(r), 'variance': round(r['variance'], 1)}
+            for r in rows
+        ]}
+
+    def search_records(self, args: Dict) -> Dict:
+        query = str(args.get('query') or '').strip()
+        if not query:
+            raise ValueError('queryを指定してください')
+        rows = self.db.search_kousu(query, limit=self._limit(args), **self._period(args))
+        return {'rows': [self._search_row(r) for r in rows]}
+
+    def _search_row(self, r: Dict) -> Dict:
+        # 案件・メンバーそのものが一致した行（工数レコードがない場合も含む）
+        if r['kind'] == 'project':
+            return {'kind': 'project', 'project': r['project_name'], 'client': r['client'] or None,
+                    'description': r['description'] or None}
+        if r['kind'] == 'member':
+            return {'kind': 'member', 'member': r['member_name']}
+        return {'kind': 'record', 'project': r['project_name'], 'client': r['client'] or None,
+                'member': r['member_name'] or '未割当', 'period': f"{r['year']}-{r['month']:02d}",
+                **self._hours(r), 'notes': r['notes'] or None}
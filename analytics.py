@@ -0,0 +1,185 @@
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from cache import LRUCache
+from metrics import timed_query
+
+
+def month_label(period: int) -> str:
+    """period（year*12+month）を 'YYYY/MM' に変換（ダッシュボードと同じ表記）"""
+    year, month = divmod(period - 1, 12)
+    return f"{year}/{month + 1:02d}"
+
+
+class KousuAnalytics:
+    """見積・予定との差分、見積精度、累積の消化率、前月比を月次集計テーブルからSQLのウィンドウ関数で計算する
+
+    結果は期間・集計単位とデータバージョンをキーにキャッシュし、/api/analytics・ダッシュボード・
+    エージェントで同じ計算結果を使う（データが更新されるまで再計算しない）。
+    """
+
+    # 集計単位ごとの (集計テーブル, キー列, ID, 名前)
+    GROUPS = {
+        'project': ('kousu_project_monthly', 'r.project_id', 'x.item_id', 'p.name'),
+        'member': ('kousu_member_monthly', 'r.member_key', "NULLIF(x.item_id, 0)", "COALESCE(m.name, '未割当')"),
+    }
+
+    # 月ごとの値・差分・精度と、期間の先頭からの累積・消化率（累積実績 / 累積見積）・前月比
+    # （前月の行がない＝前月の工数0として扱い、期間の最初の月は前月比なし）
+    WINDOW_SQL = '''
+        SELECT x.*,
+            x.actual_hours - x.estimated_hours AS estimate_variance,
+            x.actual_hours - x.planned_hours AS plan_variance,
+            x.actual_hours / NULLIF(x.estimated_hours, 0) AS estimate_accuracy,
+            x.cumulative_actual / NULLIF(x.cumulative_estimated, 0) AS burn_rate,
+            x.cumulative_actual / NULLIF(x.cumulative_planned, 0) AS plan_burn_rate,
+            x.actual_hours - x.previous_actual AS mom_change,
+            (x.actual_hours - x.previous_actual) / NULLIF(x.previous_actual, 0) AS mom_ratio
+        FROM (
+            SELECT monthly.*,
+                SUM(estimated_hours) OVER cumulative AS cumulative_estimated,
+                SUM(planned_hours) OVER cumulative AS cumulative_planned,
+                SUM(actual_hours) OVER cumulative AS cumulative_actual,
+                CASE
+                    WHEN LAG(period) OVER ordered = period - 1 THEN LAG(actual_hours) OVER ordered
+                    WHEN LAG(period) OVER ordered IS NOT NULL THEN 0
+                END AS previous_actual,
+                SUM(actual_hours) OVER item - SUM(estimated_hours) OVER item AS total_variance,
+                ROW_NUMBER() OVER (PARTITION BY item_id ORDER BY period DESC) AS recency
+            FROM ({monthly}) monthly
+            WINDOW item AS (PARTITION BY item_id),
+                ordered AS (PARTITION BY item_id ORDER BY period),
+                cumulative AS (PARTITION BY item_id ORDER BY period ROWS UNBOUNDED PRECEDING)
+        ) x
+    '''
+
+    # 明細（案件・メンバー・年月ごと）の差分・精度（get_kousu_by_period と同じ並び）
+    RECORD_SQL = '''
+        SELECT k.id, k.project_id, k.member_id, k.year, k.month,
+            k.estimated_hours, k.planned_hours, k.actual_hours, k.notes,
+            p.name AS project_name, p.client, m.name AS member_name,
+            k.actual_hours - k.estimated_hours AS estimate_variance,
+            k.actual_hours - k.planned_hours AS plan_variance,
+            k.actual_hours / NULLIF(k.estimated_hours, 0) AS estimate_accuracy
+        FROM kousu_records k
+        JOIN projects p ON p.id = k.project_id
+        LEFT JOIN members m ON m.id = k.member_id
+        {where}
+        ORDER BY k.period DESC, p.name, COALESCE(m.name, ''), k.id
+    '''
+
+    MONTH_FIELDS = ('estimated_hours', 'planned_hours', 'actual_hours',
+                    'estimate_variance', 'plan_variance', 'estimate_accuracy',
+                    'cumulative_estimated', 'cumulative_planned', 'cumulative_actual',
+                    'burn_rate', 'plan_burn_rate', 'mom_change', 'mom_ratio')
+
+    def __init__(self, database, cache_entries: Optional[int] = None):
+        self.db = database
+        cache_entries = cache_entries if cache_entries is not None else int(os.getenv('KOUSU_ANALYTICS_CACHE_ENTRIES', '64'))
+        self.cache = LRUCache(cache_entries) if cache_entries > 0 else None
+
+    def get(self, group_by: str = 'project', year: Optional[int] = None, month: Optional[int] = None,
+            period_from: Optional[Tuple[int, int]] = None, period_to: Optional[Tuple[int, int]] = None,
+            series: bool = False) -> Dict:
+        """期間の分析結果（キャッシュから返すため、呼び出し側で変更しないこと）
+
+        series=True で案件・メンバーごとの月別の推移（months）も含める。
+        """
+        if group_by not in self.GROUPS:
+            raise ValueError(f"invalid group_by: {group_by}")
+        if self.cache is None:
+            return self.compute(group_by, year, month, period_from, period_to, series)
+
+        version = self.db.get_data_version()
+        key = (group_by, year, month, period_from, period_to, series)
+        found, result = self.cache.get(key, version)
+        if not found:
+            result = self.compute(group_by, year, month, period_from, period_to, series)
+            self.cache.put(key, result, version)
+        return result
+
+    def cache_stats(self) -> Optional[Dict]:
+        return self.cache.stats() if self.cache is not None else None
+
+    @staticmethod
+    def _totals(row) -> Dict:
+        """最後の月の累積値から期間合計の差分・精度を作る"""
+        estimated, planned, actual = row['cumulative_estimated'], row['cumulative_planned'], row['cumulative_actual']
+        return {
+            'estimated_hours': estimated,
+            'planned_hours': planned,
+            'actual_hours': actual,
+            'estimate_variance': actual - estimated,
+            'plan_variance': actual - planned,
+            # 実績 / 見積（1.0で見積通り、1を超えると超過）
+            'estimate_accuracy': row['burn_rate'],
+            'plan_accuracy': row['plan_burn_rate'],
+        }
+
+    def _month(self, row) -> Dict:
+        month = {'month': month_label(row['period'])}
+        month.update((field, row[field]) for field in self.MONTH_FIELDS)
+        return month
+
+    def iter_records(self, year: Optional[int] = None, month: Optional[int] = None,
+                     period_from: Optional[Tuple[int, int]] = None,
+                     period_to: Optional[Tuple[int, int]] = None) -> Iterator[Dict]:
+        """明細を差分（実績 - 見積 / 実績 - 予定）・見積精度付きで1件ずつ返す（キャッシュしない）"""
+        where, params = self.db._period_filter('k', year, month, period_from, period_to)
+        return self.db._iter_rows(self.RECORD_SQL.format(where=where), params)
+
+    @timed_query
+    def compute(self, group_by: str = 'project', year: Optional[int] = None, month: Optional[int] = None,
+                period_from: Optional[Tuple[int, int]] = None, period_to: Optional[Tuple[int, int]] = None,
+                series: bool = False) -> Dict:
+        """キャッシュを使わずに計算"""
+        table, key, item_id, item_name = self.GROUPS[group_by]
+        where, params = self.db._period_filter('r', year, month, period_from, period_to)
+        conn = self.db.get_connection()
+
+        # 全体の月次推移（全案件の合計を1系列として同じ計算を行う）
+        summary_rows = conn.execute(self.WINDOW_SQL.format(monthly=f'''
+            SELECT 0 AS item_id, r.period,
+                SUM(r.estimated_hours) AS estimated_hours,
+                SUM(r.planned_hours) AS planned_hours,
+                SUM(r.actual_hours) AS actual_hours
+            FROM kousu_project_monthly r
+            {where}
+            GROUP BY r.period
+        ''') + " ORDER BY x.period", params).fetchall()
+
+        join = ("JOIN projects p ON p.id = x.item_id" if group_by == 'project'
+                else "LEFT JOIN members m ON m.id = x.item_id")
+        # 期間合計の差分（絶対値）が大きい順。series 指定がなければ各項目の最後の月の行だけを読む
+        item_rows = conn.execute(f'''
+            SELECT {item_id} AS id, {item_name} AS name, x.*
+            FROM ({self.WINDOW_SQL.format(monthly=f"""
+                SELECT {key} AS item_id, r.period, r.estimated_hours, r.planned_hours, r.actual_hours
+                FROM {table} r
+                {where}
+            """)}) x
+            {join}
+            {'' if series else 'WHERE x.recency = 1'}
+            ORDER BY ABS(x.total_variance) DESC, name, x.item_id, x.period
+        ''', params).fetchall()
+
+        items: List[Dict] = []
+        current, current_key = None, None
+        for row in item_rows:
+            if current is None or current_key != row['item_id']:
+                current, current_key = {'id': row['id'], 'name': row['name']}, row['item_id']
+                if series:
+                    current['months'] = []
+                items.append(current)
+            if series:
+                current['months'].append(self._month(row))
+            if row['recency'] == 1:
+                current.update(self._totals(row))
+                current['last_month'] = self._month(row)
+
+        return {
+            'group_by': group_by,
+            'months': [self._month(row) for row in summary_rows],
+            'totals': self._totals(summary_rows[-1]) if summary_rows else None,
+            'items': items,
+        }
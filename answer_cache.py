@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from typing import Optional
+
+from cache import LRUCache
+from connections import ThreadConnections
+
+
+def normalize_message(message: str) -> str:
+    """全角半角・大文字小文字・空白・末尾の句読点の違いを吸収"""
+    text = unicodedata.normalize('NFKC', message).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('?!。.、, ')
+
+
+class AnswerCache:
+    """エージェント回答のキャッシュ（質問・期間・データバージョン単位）
+
+    プロセス内のLRUに加え、db_path を指定するとSQLiteファイルに保存して
+    gunicornの全ワーカーで共有する。データが更新されると（バージョンが変わると）無効になる。
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, ttl: Optional[float] = None,
+                 db_path: Optional[str] = None):
+        max_entries = max_entries if max_entries is not None else int(os.getenv('KOUSU_AGENT_CACHE_ENTRIES', '256'))
+        self.ttl = ttl if ttl is not None else float(os.getenv('KOUSU_AGENT_CACHE_TTL', '3600'))
+        self.memory = LRUCache(max_entries) if max_entries > 0 else None
+        self.db_path = db_path if db_path is not None else os.getenv('KOUSU_AGENT_CACHE_DB')
+        self._connections = ThreadConnections(self._connect)
+        if self.db_path:
+            conn = self._get_connection()
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS agent_answers (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    answer TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _get_connection(self):
+        # fork後は子プロセスで接続を作り直す（親の接続は ThreadConnections が保持したままにする）
+        return self._connections.get()
+
+    @staticmethod
+    def make_key(message: str, year: Optional[int], month: Optional[int]) -> str:
+        raw = f"{normalize_message(message)}\x00{year}\x00{month}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, message: str, year: Optional[int], month: Optional[int], version: int) -> Optional[str]:
+        key = self.make_key(message, year, month)
+        now = time.time()
+
+        if self.memory is not None:
+            found, entry = self.memory.get(key, version)
+            if found:
+                answer, expires_at = entry
+                if expires_at > now:
+                    return answer
+
+        if self.db_path:
+            row = self._get_connection().execute(
+                "SELECT answer, created_at FROM agent_answers WHERE key = ? AND version = ? AND created_at > ?",
+                (key, version, now - self.ttl)
+            ).fetchone()
+            if row:
+                if self.memory is not None:
+                    self.memory.put(key, (row[0], row[1] + self.ttl), version)
+                return row[0]
+        return None
+
+    def put(self, message: str, year: Optional[int], month: Optional[int], version: int, answer: str):
+        key = self.make_key(message, year, month)
+        now = time.time()
+
+        if self.memory is not None:
+            self.memory.put(key, (answer, now + self.ttl), version)
+
+        if self.db_path:
+            conn = self._get_connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO agent_answers (key, version, answer, created_at) VALUES (?, ?, ?, ?)",
+                    (key, version, answer, now)
+                )
+                # 古いバージョン・期限切れの回答を削除
+                conn.execute(
+                    "DELETE FROM agent_answers WHERE version < ? OR created_at <= ?",
+                    (version, now - self.ttl)
+                )
+
+    def stats(self) -> Optional[dict]:
+        return self.memory.stats() if self.memory is not None else None
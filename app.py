@@ -1,20 +1,128 @@
-from flask import Flask, send_from_directory, request, jsonify
-from database import Database
+from flask import Flask, Blueprint, current_app, request, jsonify, Response, stream_with_context
+from werkzeug.local import LocalProxy
+from dotenv import load_dotenv
+from database import Database, parse_period
 from agent import KousuAgent
+from analytics import KousuAnalytics
+from jobs import AgentJobQueue, QueueFullError
+from metrics import registry, http_request_duration
+from http_cache import StaticFileCache, make_etag, etag_matches, not_modified, compress_response
+from columnar import encode_columnar
+from export import DETAIL_COLUMNS, PROJECT_COLUMNS, MEMBER_COLUMNS, XLSX_MIMETYPE, iter_csv, iter_xlsx
 import os
+import io
+import csv
+import json
+import base64
+import functools
+import logging
+import time
 from datetime import datetime
 
-app = Flask(__name__)
-db = Database()
-agent = KousuAgent(db)
+# .env の LOG_LEVEL 等もログ設定に反映されるよう、先に読み込む
+load_dotenv()
 
-@app.route('/')
+# ログレベルは環境変数 LOG_LEVEL で切り替え（DEBUG/INFO/WARNING/ERROR）
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s [%(name)s] %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('kousu', __name__, cli_group=None)
+
+# create_app() で作成したアプリ毎のDB・エージェント（リクエスト中に current_app から解決する）
+db = LocalProxy(lambda: current_app.extensions['kousu']['db'])
+agent = LocalProxy(lambda: current_app.extensions['kousu']['agent'])
+agent_jobs = LocalProxy(lambda: current_app.extensions['kousu']['agent_jobs'])
+analytics = LocalProxy(lambda: current_app.extensions['kousu']['analytics'])
+static_files = StaticFileCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+
+
+def create_app(database=None):
+    """アプリケーションファクトリ（gunicorn "app:create_app()"）
+
+    スキーマの確認・マイグレーションはここで1回だけ行う。gunicornの preload_app では
+    マスタープロセスで実行され、ワーカーはfork後に各自の接続を開く。
+    OpenAIクライアントは最初にエージェントを使うときに作成する。
+    """
+    app = Flask(__name__)
+    if database is None:
+        database = Database()
+        # 初期化に使った接続はfork先へ持ち越さない
+        database.close()
+    # 分析結果はAPI・ダッシュボードとエージェントで共有する
+    analytics = KousuAnalytics(database)
+    agent = KousuAgent(database, analytics=analytics)
+    app.extensions['kousu'] = {
+        'db': database,
+        'agent': agent,
+        'analytics': analytics,
+        # エージェントのジョブ状態は全ワーカーで共有するSQLiteファイルに保存
+        'agent_jobs': AgentJobQueue(agent, os.getenv('KOUSU_AGENT_JOBS_DB') or os.path.join(
+            os.path.dirname(os.path.abspath(database.db_name)), 'agent_jobs.db')),
+    }
+    app.register_blueprint(bp)
+    return app
+
+# /metrics で出力するキャッシュ・ジョブの状態
+def _cache_gauges():
+    for name, stats in (('db', db.cache_stats()), ('analytics', analytics.cache_stats()),
+                        ('agent_answers', agent.answer_cache.stats())):
+        if stats is None:
+            continue
+        for key in ('entries', 'hits', 'misses', 'evictions', 'invalidations'):
+            yield {'cache': name, 'stat': key}, stats[key]
+
+def _job_gauges():
+    for status, count in agent_jobs.stats()['jobs'].items():
+        yield {'status': status}, count
+
+registry.gauge_callback('kousu_cache', 'Read cache statistics', _cache_gauges)
+registry.gauge_callback('kousu_agent_jobs', 'Agent jobs by status', _job_gauges)
+
+
+def versioned(view):
+    """GETの結果がデータバージョンとクエリだけで決まるAPIにETagを付け、一致すれば304を返す"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+        etag = make_etag(db.get_data_version(), request.full_path, request.headers.get('Accept', ''))
+        if etag_matches(etag):
+            return not_modified(etag)
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+@bp.before_app_request
+def start_timer():
+    request.environ['kousu.start_time'] = time.perf_counter()
+
+@bp.after_app_request
+def record_request(response):
+    start = request.environ.get('kousu.start_time')
+    if start is not None:
+        # ルート単位で集計（URLの値ごとに系列が増えないようにする）
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_duration.observe(time.perf_counter() - start, method=request.method,
+                                      route=route, status=response.status_code)
+    return response
+
+@bp.after_app_request
+def compress(response):
+    return compress_response(response)
+
+@bp.route('/')
 def index():
-    # staticフォルダからindex.htmlを配信
-    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    return send_from_directory(static_dir, 'index.html')
+    # staticフォルダのindex.htmlを配信（gzip版・ETagはメモリにキャッシュ）
+    return static_files.send('index.html', 'text/html')
 
-@app.route('/api/projects', methods=['GET', 'POST'])
+@bp.route('/api/projects', methods=['GET', 'POST'])
+@versioned
 def projects():
     if request.method == 'GET':
         projects = db.get_all_projects()
@@ -29,7 +137,8 @@ def projects():
         )
         return jsonify({'success': True, 'project_id': project_id})
 
-@app.route('/api/members', methods=['GET', 'POST'])
+@bp.route('/api/members', methods=['GET', 'POST'])
+@versioned
 def members():
     if request.method == 'GET':
         members = db.get_all_members()
@@ -43,7 +152,7 @@ def members():
         )
         return jsonify({'success': True, 'member_id': member_id})
 
-@app.route('/api/kousu', methods=['POST'])
+@bp.route('/api/kousu', methods=['POST'])
 def add_kousu():
     data = request.json
     member_id = data.get('member_id')
@@ -64,60 +173,362 @@ def add_kousu():
     )
     return jsonify({'success': success})
 
-@app.route('/api/kousu/list', methods=['GET'])
+@bp.route('/api/kousu/bulk', methods=['POST'])
+def bulk_kousu():
+    """工数の一括登録（JSON配列 または CSVアップロード）"""
+    if request.mimetype in ('text/csv', 'application/csv'):
+        # CSV本文をそのままストリームで読み込む
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+        rows = csv.DictReader(stream)
+    elif 'file' in request.files:
+        stream = io.TextIOWrapper(request.files['file'].stream, encoding='utf-8-sig', newline='')
+        rows = csv.DictReader(stream)
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get('records')
+        if not isinstance(data, list):
+            return jsonify({'success': False, 'error': 'JSON配列またはCSVを送信してください'}), 400
+        rows = data
+
+    try:
+        result = db.bulk_upsert_kousu(rows)
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'success': False, 'error': f'CSVの読み込みに失敗しました: {e}'}), 400
+
+    result['success'] = result['error_count'] == 0
+    return jsonify(result)
+
+def encode_cursor(record):
+    key = json.dumps(db.kousu_sort_key(record), ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    if not isinstance(key, list) or len(key) != 5:
+        raise ValueError('invalid cursor')
+    # kousu_sort_key の (年, 月, 案件名, メンバー名, id)。bool は int として通さない
+    year, month, project_name, member_name, record_id = key
+    if (not all(type(value) is int for value in (year, month, record_id))
+            or not all(value is None or isinstance(value, str) for value in (project_name, member_name))):
+        raise ValueError('invalid cursor')
+    # 並び順ではNULLのメンバー名を''として扱う
+    return year, month, project_name or '', member_name or '', record_id
+
+def parse_paging_args():
+    """limit/cursor クエリパラメータを解析（不正な値はValueError）"""
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError('cursorが不正です')
+    if limit is not None and limit <= 0:
+        raise ValueError('limitは1以上を指定してください')
+    return after, limit
+
+def parse_period_args():
+    """year/month と from/to（YYYY-MM、両端を含む）クエリパラメータを解析（不正な値はValueError）"""
+    return {
+        'year': request.args.get('year', type=int),
+        'month': request.args.get('month', type=int),
+        'period_from': parse_period(request.args.get('from'), 'from'),
+        'period_to': parse_period(request.args.get('to'), 'to'),
+    }
+
+def records_payload(records):
+    """format=columnar 指定時は列指向JSON（列名1回・案件名等は辞書化）に変換"""
+    if request.args.get('format') == 'columnar':
+        return encode_columnar(records)
+    return records
+
+@bp.route('/api/kousu/list', methods=['GET'])
+@versioned
 def list_kousu():
-    year = request.args.get('year', type=int)
-    month = request.args.get('month', type=int)
-    records = db.get_kousu_by_period(year, month)
-    return jsonify(records)
+    try:
+        period = parse_period_args()
+        after, limit = parse_paging_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # NDJSON: 1行1レコードでストリーミング（ワーカーのメモリを一定に保つ）
+    if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        def generate():
+            for record in db.iter_kousu_by_period(after=after, limit=limit, **period):
+                yield json.dumps(record, ensure_ascii=False) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # ページング指定なしは従来通り配列で返す
+    if limit is None and after is None:
+        records = db.get_kousu_by_period(**period)
+        return jsonify(records_payload(records))
+
+    # 次ページの有無を判定するため1件多く取得
+    records = db.get_kousu_by_period(after=after, limit=limit + 1 if limit else None, **period)
+    next_cursor = None
+    if limit and len(records) > limit:
+        records = records[:limit]
+        next_cursor = encode_cursor(records[-1])
+    return jsonify({'records': records_payload(records), 'next_cursor': next_cursor})
 
-@app.route('/api/kousu/by-project', methods=['GET'])
+@bp.route('/api/kousu/by-project', methods=['GET'])
+@versioned
 def kousu_by_project():
-    year = request.args.get('year', type=int)
-    month = request.args.get('month', type=int)
-    records = db.get_kousu_by_project(year, month)
+    try:
+        period = parse_period_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    records = db.get_kousu_by_project(**period)
     return jsonify(records)
 
-@app.route('/api/kousu/by-member', methods=['GET'])
+@bp.route('/api/kousu/by-member', methods=['GET'])
+@versioned
 def kousu_by_member():
-    year = request.args.get('year', type=int)
-    month = request.args.get('month', type=int)
-    records = db.get_kousu_by_member(year, month)
-    return jsonify(records)
+    try:
+        period = parse_period_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    records = db.get_kousu_by_member(**period)
+    return jsonify(records_payload(records))
 
-@app.route('/api/kousu/summary', methods=['GET'])
+@bp.route('/api/kousu/summary', methods=['GET'])
+@versioned
 def kousu_summary():
-    year = request.args.get('year', type=int)
-    month = request.args.get('month', type=int)
-    summary = db.get_summary_by_period(year, month)
+    try:
+        period = parse_period_args()
+        after, limit = parse_paging_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # records=none で合計のみ返す（サマリーカードの更新用）
+    if request.args.get('records') == 'none':
+        return jsonify(db.get_summary_by_period(include_records=False, **period))
+
+    if limit is None and after is None:
+        summary = db.get_summary_by_period(**period)
+        summary['records'] = records_payload(summary['records'])
+        return jsonify(summary)
+
+    # recordsをページング（次ページ判定のため1件多く取得）
+    summary = db.get_summary_by_period(after=after, limit=limit + 1 if limit else None, **period)
+    summary['next_cursor'] = None
+    if limit and len(summary['records']) > limit:
+        summary['records'] = summary['records'][:limit]
+        summary['next_cursor'] = encode_cursor(summary['records'][-1])
+    summary['records'] = records_payload(summary['records'])
     return jsonify(summary)
 
-@app.route('/api/periods', methods=['GET'])
+# エクスポート対象（URL名: (Databaseのイテレーター, 列定義, ファイル名)）
+EXPORTS = {
+    'detail': ('iter_kousu_by_period', DETAIL_COLUMNS, 'kousu_detail'),
+    'by-project': ('iter_kousu_by_project', PROJECT_COLUMNS, 'kousu_by_project'),
+    'by-member': ('iter_kousu_by_member', MEMBER_COLUMNS, 'kousu_by_member'),
+}
+
+EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (iter_xlsx, XLSX_MIMETYPE),
+}
+
+@bp.route('/api/export/<view>', methods=['GET'])
+@versioned
+def export(view):
+    """明細・案件別・メンバー別をCSV/XLSXでダウンロード（カーソルから逐次書き出す）"""
+    fmt = request.args.get('format', 'csv')
+    if view not in EXPORTS or fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'エクスポート対象または形式が不正です'}), 404
+    try:
+        period = parse_period_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    method, columns, basename = EXPORTS[view]
+    writer, mimetype = EXPORT_FORMATS[fmt]
+    suffix = ''.join(f"_{value}" for value in (period['year'], period['month']) if value is not None)
+    if period['period_from'] or period['period_to']:
+        suffix += '_' + '-'.join('%04d%02d' % p if p else '' for p in (period['period_from'], period['period_to']))
+
+    records = getattr(db, method)(**period)
+    response = Response(stream_with_context(writer(columns, records)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{basename}{suffix}.{fmt}"'
+    return response
+
+# 検索結果の1ページあたりの件数（既定・上限）
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+@bp.route('/api/search', methods=['GET'])
+@versioned
+def search():
+    """案件名・クライアント・説明・メンバー名・備考の全文検索（q、year/month・from/to、limit/offset）
+
+    結果の kind は record（工数レコード）・project（案件）・member（メンバー）。期間指定時は record のみ。
+    2文字以上の語は索引で引く。1文字の語は索引を使えず明細を順に照合するため、
+    1文字の語だけの検索は件数に比例して遅くなり、工数レコードのみを返す。
+    """
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    try:
+        period = parse_period_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not query:
+        return jsonify({'error': 'qを指定してください'}), 400
+    if not 1 <= limit <= SEARCH_MAX_LIMIT:
+        return jsonify({'error': f'limitは1〜{SEARCH_MAX_LIMIT}で指定してください'}), 400
+    if offset < 0:
+        return jsonify({'error': 'offsetは0以上を指定してください'}), 400
+
+    # 次ページの有無を判定するため1件多く取得
+    results = db.search_kousu(query, limit=limit + 1, offset=offset, **period)
+    next_offset = offset + limit if len(results) > limit else None
+    return jsonify({'results': results[:limit], 'next_offset': next_offset})
+
+@bp.route('/api/analytics', methods=['GET'])
+@versioned
+def get_analytics():
+    """見積・予定との差分、見積精度、累積の消化率、前月比（group_by=project|member、series=1で月別推移を含める）"""
+    group_by = request.args.get('group_by', 'project')
+    if group_by not in KousuAnalytics.GROUPS:
+        return jsonify({'error': 'group_byはprojectまたはmemberを指定してください'}), 400
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        return jsonify({'error': 'limitは1以上を指定してください'}), 400
+    try:
+        period = parse_period_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    result = analytics.get(group_by, series=request.args.get('series') == '1', **period)
+    if limit is not None:
+        # キャッシュ済みの結果は変更しない
+        result = dict(result, items=result['items'][:limit])
+    return jsonify(result)
+
+@bp.route('/api/dashboard', methods=['GET'])
+@versioned
+def dashboard():
+    try:
+        period = parse_period_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # ダッシュボードは年単位または from/to の範囲で集計する
+    period.pop('month')
+    data = db.get_dashboard_data(**period)
+    return jsonify(data)
+
+@bp.route('/api/periods', methods=['GET'])
+@versioned
 def get_periods():
     periods = db.get_all_years_months()
     return jsonify(periods)
 
-@app.route('/api/agent/chat', methods=['POST'])
+@bp.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(db.cache_stats())
+
+@bp.route('/api/agent/chat', methods=['POST'])
 def agent_chat():
     try:
-        print("[DEBUG] Agent chat endpoint called")
         data = request.json
-        print(f"[DEBUG] Request data: {data}")
         message = data.get('message', '')
         year = data.get('year')
         month = data.get('month')
 
-        print(f"[DEBUG] Calling agent.chat with message: {message}, year: {year}, month: {month}")
-        response = agent.chat(message, year, month)
-        print(f"[DEBUG] Agent response length: {len(response) if response else 0}")
-        print(f"[DEBUG] Agent response preview: {response[:100] if response else 'None'}")
+        logger.debug("agent chat: year=%s month=%s message_length=%d", year, month, len(message))
+        # ジョブと同じ期限で打ち切る（gunicornのワーカータイムアウトより短い）
+        response = agent.chat(message, year, month, deadline=time.time() + agent_jobs.timeout)
+        logger.debug("agent chat: response_length=%d", len(response) if response else 0)
 
         return jsonify({'response': response})
+    except TimeoutError as e:
+        logger.warning("agent chat timed out: %s", e)
+        return jsonify({'response': f'タイムアウトしました: {e}', 'timeout': True}), 504
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"[ERROR] Exception in agent_chat: {error_details}")
+        logger.exception("Exception in agent_chat")
         return jsonify({'response': f'エラーが発生しました: {str(e)}'}), 500
 
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheusテキスト形式のメトリクス（ワーカープロセス単位）"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.cli.command('rebuild-rollups')
+def rebuild_rollups():
+    """月次集計テーブルを再構築（flask --app app rebuild-rollups）"""
+    db.rebuild_rollups()
+    print('月次集計テーブルを再構築しました')
+
+@bp.route('/api/agent/jobs', methods=['POST'])
+def submit_agent_job():
+    """エージェントへの質問をバックグラウンドジョブとして投入"""
+    data = request.json or {}
+    try:
+        job = agent_jobs.submit(data.get('message', ''), data.get('year'), data.get('month'))
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 429
+    return jsonify(job), 202
+
+@bp.route('/api/agent/jobs/<job_id>', methods=['GET', 'DELETE'])
+def agent_job(job_id):
+    if request.method == 'DELETE':
+        job = agent_jobs.cancel(job_id)
+    else:
+        job = agent_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(job)
+
+@bp.route('/api/agent/jobs/<job_id>/result', methods=['GET'])
+def agent_job_result(job_id):
+    job = agent_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    if job['status'] in ('queued', 'running'):
+        return jsonify({'status': job['status']}), 202
+    if job['status'] != 'done':
+        return jsonify({'status': job['status'], 'error': job['error']}), 409
+    return jsonify({'status': job['status'], 'response': job['response']})
+
+@bp.route('/api/agent/jobs/stats', methods=['GET'])
+def agent_job_stats():
+    return jsonify(agent_jobs.stats())
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@bp.route('/api/agent/chat/stream', methods=['POST'])
+def agent_chat_stream():
+    """エージェントの回答をServer-Sent Eventsで逐次送信"""
+    data = request.json or {}
+    message = data.get('message', '')
+    year = data.get('year')
+    month = data.get('month')
+
+    deadline = time.time() + agent_jobs.timeout
+
+    def generate():
+        try:
+            for text in agent.chat_stream(message, year, month, deadline=deadline):
+                yield sse_event('token', {'text': text})
+            yield sse_event('done', {})
+        except TimeoutError as e:
+            logger.warning("agent chat stream timed out: %s", e)
+            yield sse_event('error', {'message': str(e), 'timeout': True})
+        except Exception as e:
+            logger.exception("Exception in agent_chat_stream")
+            yield sse_event('error', {'message': str(e)})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # リバースプロキシでのバッファリングを無効化
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
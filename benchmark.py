@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DatabaseメソッドとHTTP APIのベンチマーク
+合成データを投入した一時DBに対して各処理を繰り返し実行し、
+p50/p95レイテンシ・行数/秒・ピークメモリをJSONで出力する
+
+例: python benchmark.py --projects 500 --members 200 --years 5 --output result.json
+    python benchmark.py --baseline result.json   # 前回結果との比較
+"""
+
+import argparse
+import csv
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime
+from typing import Callable, Dict, List
+from urllib.parse import quote
+
+import datagen
+from analytics import KousuAnalytics
+from database import Database
+from export import XLSX_MIMETYPE
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def count_rows(result) -> int:
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        if 'columns' in result and 'length' in result:
+            return result['length']
+        if isinstance(result.get('records'), (list, dict)):
+            return count_rows(result['records'])
+        if isinstance(result.get('results'), list):
+            return len(result['results'])
+        if isinstance(result.get('months'), list):
+            return len(result['months'])
+        return 1
+    return 0 if result is None else 1
+
+
+def measure(func: Callable[[], int], iterations: int, warmup: int = 1) -> Dict:
+    """funcを繰り返し実行（funcは処理した行数を返す）"""
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    rows = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        rows = func()
+        timings.append(time.perf_counter() - start)
+
+    # ピークメモリは計測のオーバーヘッドがあるため別に1回だけ実行
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = sum(timings)
+    return {
+        'iterations': iterations,
+        'rows': rows,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'mean_ms': statistics.mean(timings) * 1000,
+        'rows_per_sec': rows * iterations / total if total else None,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def database_cases(db: Database, year: int, month: int) -> Dict[str, Callable[[], int]]:
+    cases = {
+        'get_all_projects': lambda: count_rows(db.get_all_projects()),
+        'get_all_members': lambda: count_rows(db.get_all_members()),
+        'get_all_years_months': lambda: count_rows(db.get_all_years_months()),
+        'iter_kousu_by_period[all]': lambda: sum(1 for _ in db.iter_kousu_by_period()),
+        'get_kousu_by_period[page=100]': lambda: count_rows(db.get_kousu_by_period(None, None, None, 100)),
+        'get_summary_by_period[totals]': lambda: count_rows(
+            db.get_summary_by_period(year, month, include_records=False)),
+        'get_dashboard_data[all]': lambda: count_rows(db.get_dashboard_data()),
+        'get_dashboard_data[year]': lambda: count_rows(db.get_dashboard_data(year)),
+    }
+    analytics = KousuAnalytics(db, cache_entries=0)
+    for group_by in ('project', 'member'):
+        cases[f'analytics[{group_by},all]'] = lambda g=group_by: len(analytics.compute(g)['items'])
+        cases[f'analytics[{group_by},year]'] = lambda g=group_by: len(analytics.compute(g, year)['items'])
+    for label, args in (('all', ()), ('year', (year,)), ('month', (year, month))):
+        cases[f'get_kousu_by_period[{label}]'] = lambda a=args: count_rows(db.get_kousu_by_period(*a))
+        cases[f'get_kousu_by_project[{label}]'] = lambda a=args: count_rows(db.get_kousu_by_project(*a))
+        cases[f'get_kousu_by_member[{label}]'] = lambda a=args: count_rows(db.get_kousu_by_member(*a))
+        cases[f'get_summary_by_period[{label}]'] = lambda a=args: count_rows(db.get_summary_by_period(*a))
+    return cases
+
+
+def http_cases(client, year: int, month: int) -> Dict[str, Callable[[], int]]:
+    def get(url):
+        def run():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+            body = response.get_data()
+            if response.mimetype == 'application/x-ndjson':
+                return body.count(b'\n')
+            if response.mimetype == 'text/csv':
+                # 見出し行を除いた行数（備考の改行を数えないようCSVとして読む）
+                return sum(1 for _ in csv.reader(io.StringIO(body.decode('utf-8-sig')))) - 1
+            if response.mimetype == XLSX_MIMETYPE:
+                with zipfile.ZipFile(io.BytesIO(body)) as archive:
+                    return archive.read('xl/worksheets/sheet1.xml').count(b'<row ') - 1
+            if response.mimetype != 'application/json':
+                return len(body)
+            return count_rows(json.loads(body))
+        return run
+
+    return {
+        'GET /': get('/'),
+        'GET /api/projects': get('/api/projects'),
+        'GET /api/members': get('/api/members'),
+        'GET /api/periods': get('/api/periods'),
+        'GET /api/kousu/list': get('/api/kousu/list'),
+        'GET /api/kousu/list?year': get(f'/api/kousu/list?year={year}'),
+        'GET /api/kousu/list?year&month': get(f'/api/kousu/list?year={year}&month={month}'),
+        'GET /api/kousu/list?limit=100': get('/api/kousu/list?limit=100'),
+        'GET /api/kousu/list?format=ndjson': get('/api/kousu/list?format=ndjson'),
+        'GET /api/kousu/list?format=columnar': get('/api/kousu/list?format=columnar'),
+        'GET /api/kousu/by-project': get('/api/kousu/by-project'),
+        'GET /api/kousu/by-project?year': get(f'/api/kousu/by-project?year={year}'),
+        'GET /api/kousu/by-member': get('/api/kousu/by-member'),
+        'GET /api/kousu/by-member?year': get(f'/api/kousu/by-member?year={year}'),
+        'GET /api/kousu/by-member?format=columnar': get('/api/kousu/by-member?format=columnar'),
+        'GET /api/kousu/summary?records=none': get(f'/api/kousu/summary?records=none&year={year}'),
+        'GET /api/kousu/summary?year&month': get(f'/api/kousu/summary?year={year}&month={month}'),
+        'GET /api/kousu/summary?format=columnar': get(f'/api/kousu/summary?year={year}&format=columnar'),
+        'GET /api/dashboard': get('/api/dashboard'),
+        'GET /api/dashboard?year': get(f'/api/dashboard?year={year}'),
+        'GET /api/analytics?year': get(f'/api/analytics?year={year}'),
+        'GET /api/analytics?group_by=member': get('/api/analytics?group_by=member'),
+        # 3文字以上の語は trigram、2文字の語は2文字ずつの列で索引を引く
+        'GET /api/search?q=trigram': get(f"/api/search?q={quote('障害調査')}&limit=100"),
+        'GET /api/search?q=bigram': get(f"/api/search?q={quote('障害')}&limit=100"),
+        'GET /api/search?q=bigram&year': get(f"/api/search?q={quote('障害')}&year={year}&limit=100"),
+        'GET /api/export/detail?format=csv': get('/api/export/detail?format=csv'),
+        'GET /api/export/detail?format=xlsx': get('/api/export/detail?format=xlsx'),
+        'GET /api/export/detail?year&format=xlsx': get(f'/api/export/detail?year={year}&format=xlsx'),
+    }
+
+
+def make_client(db: Database):
+    from app import create_app
+
+    app = create_app(db)
+    app.config['TESTING'] = True
+    return app.test_client()
+
+
+def run(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix='kousu_bench_')
+    db_path = os.path.join(workdir, 'bench.db')
+    cache_entries = None if args.cache else 0
+
+    db = Database(db_path, cache_entries=cache_entries)
+    dataset = datagen.populate(db, args.projects, args.members, args.years, args.start_year,
+                               args.projects_per_member, args.project_level_ratio, args.seed)
+    print(f"データ生成: {dataset['records']}件 ({dataset['seconds']:.1f}秒)", file=sys.stderr)
+
+    year = args.start_year + args.years - 1
+    month = 6
+    results = {'database': {}, 'http': {}}
+
+    if 'database' in args.suites:
+        for name, func in database_cases(db, year, month).items():
+            results['database'][name] = measure(func, args.iterations)
+            print(f"  {name}: p50={results['database'][name]['p50_ms']:.2f}ms", file=sys.stderr)
+
+    if 'http' in args.suites:
+        client = make_client(db)
+        for name, func in http_cases(client, year, month).items():
+            results['http'][name] = measure(func, args.iterations)
+            print(f"  {name}: p50={results['http'][name]['p50_ms']:.2f}ms", file=sys.stderr)
+
+    db.close_all()
+    if args.keep_db:
+        print(f"ベンチマーク用DB: {db_path}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cache': args.cache,
+        },
+        'dataset': dataset,
+        'results': results,
+    }
+
+
+def compare(current: Dict, baseline: Dict) -> List[str]:
+    """前回結果とのp50/p95の比（1より大きいほど遅くなった）"""
+    lines = []
+    for suite, cases in current['results'].items():
+        for name, result in cases.items():
+            base = baseline.get('results', {}).get(suite, {}).get(name)
+            if not base:
+                continue
+            ratio50 = result['p50_ms'] / base['p50_ms'] if base['p50_ms'] else float('nan')
+            ratio95 = result['p95_ms'] / base['p95_ms'] if base['p95_ms'] else float('nan')
+            mark = ' <-- 劣化' if ratio50 > 1.2 else ''
+            lines.append(f"{suite:8s} {name:45s} p50 x{ratio50:.2f}  p95 x{ratio95:.2f}{mark}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DatabaseとHTTP APIのベンチマーク')
+    datagen.add_arguments(parser)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--suites', nargs='+', choices=['database', 'http'], default=['database', 'http'])
+    parser.add_argument('--cache', action='store_true', help='読み取りキャッシュを有効にして計測')
+    parser.add_argument('--output', help='結果JSONの出力先（省略時は標準出力）')
+    parser.add_argument('--baseline', help='比較対象の過去の結果JSON')
+    parser.add_argument('--keep-db', action='store_true', help='生成した一時DBを削除せずに残す')
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            for line in compare(report, json.load(f)):
+                print(line, file=sys.stderr)
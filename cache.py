@@ -0,0 +1,114 @@
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+def estimate_bytes(value: Any) -> int:
+    """結果のおおよそのメモリ使用量（バイト）。リストは先頭の要素の大きさ×件数で見積もる
+
+    辞書のキー（列名）は全行で共有されるため数えない。
+    """
+    if isinstance(value, (list, tuple)):
+        size = sys.getsizeof(value)
+        return size + len(value) * estimate_bytes(value[0]) if value else size
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_bytes(item) for item in value.values())
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """データバージョン付きのLRUキャッシュ（バージョンは単調増加する整数）
+
+    エントリ数（max_entries）と重みの合計（max_weight）の上限を超えると古いものから削除する。
+    重みは weigher で計算する（省略時は weigh: 結果の行数）。Database は estimate_bytes を渡すため、
+    その場合の max_weight は推定メモリ量（バイト）の上限になる。max_weight を超える1件の結果は保存しない。
+    get/put に渡すバージョンが変わった時点で全エントリを破棄する。
+    """
+
+    def __init__(self, max_entries: int = 256, max_weight: Optional[int] = None,
+                 weigher: Optional[Callable[[Any], int]] = None):
+        self.max_entries = max_entries
+        # 重みの合計の上限（weigher の単位。estimate_bytes ならバイト、省略時は行数。Noneで無制限）
+        self.max_weight = max_weight
+        if weigher is not None:
+            self.weigh = weigher
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._weight = 0
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def weigh(value: Any) -> int:
+        if isinstance(value, list):
+            return max(len(value), 1)
+        if isinstance(value, dict) and isinstance(value.get('records'), list):
+            return max(len(value['records']), 1)
+        return 1
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._weight = 0
+            self._version = version
+
+    def get(self, key: Hashable, version=None) -> Tuple[bool, Any]:
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key: Hashable, value: Any, version=None):
+        weight = self.weigh(value)
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        with self._lock:
+            # 計算中にバージョンが進んでいた場合は古い結果を保存しない
+            if self._version is not None and version is not None and version < self._version:
+                return
+            self._check_version(version)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._weight -= old[1]
+            self._entries[key] = (value, weight)
+            self._weight += weight
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_weight is not None and self._weight > self.max_weight)
+            ):
+                _, (_, evicted_weight) = self._entries.popitem(last=False)
+                self._weight -= evicted_weight
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+            self._version = None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'weight': self._weight,
+                'max_entries': self.max_entries,
+                'max_weight': self.max_weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'version': self._version,
+            }
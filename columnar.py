@@ -0,0 +1,56 @@
+"""一覧APIの列指向JSON形式（format=columnar）
+
+    {"columns": ["id", "project_name", ...],
+     "values": [[1, 2, ...], [0, 0, ...], ...],
+     "dictionaries": {"project_name": ["案件A", ...]},
+     "length": 2}
+
+列名は1回だけ、値は列ごとの配列で持つ。dictionaries に含まれる列は値が辞書配列の添字
+（NULLはnull）になっており、案件名・メンバー名のように繰り返される文字列を1回だけ送る。
+"""
+
+from typing import Any, Dict, List, Optional, Sequence
+
+
+def encode_columnar(records: Sequence[Dict[str, Any]], max_ratio: float = 0.5) -> Dict:
+    """行の配列を列指向に変換
+
+    文字列の列は、異なる値の数が件数の max_ratio 以下であれば辞書化する。
+    """
+    columns: List[str] = list(records[0].keys()) if records else []
+    values: List[List[Any]] = []
+    dictionaries: Dict[str, List[str]] = {}
+    limit = len(records) * max_ratio
+
+    for name in columns:
+        column = [record[name] for record in records]
+        index: Optional[Dict[str, int]] = {}
+        for value in column:
+            if value is None:
+                continue
+            if not isinstance(value, str):
+                index = None
+                break
+            if value not in index:
+                index[value] = len(index)
+                if len(index) > limit:
+                    index = None
+                    break
+        if index:
+            dictionaries[name] = list(index)
+            column = [None if value is None else index[value] for value in column]
+        values.append(column)
+
+    return {'columns': columns, 'values': values, 'dictionaries': dictionaries, 'length': len(records)}
+
+
+def decode_columnar(payload: Dict) -> List[Dict[str, Any]]:
+    """encode_columnar の逆変換"""
+    columns = []
+    for name, column in zip(payload['columns'], payload['values']):
+        dictionary = payload['dictionaries'].get(name)
+        if dictionary is not None:
+            column = [None if value is None else dictionary[value] for value in column]
+        columns.append(column)
+    names = payload['columns']
+    return [dict(zip(names, row)) for row in zip(*columns)] if columns else []
@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, List
+
+
+class ThreadConnections:
+    """スレッド毎のSQLite接続（fork後は子プロセスで作り直す）
+
+    fork前に親プロセスが開いた接続は子プロセスで使用もクローズもしない
+    （クローズするとWALのチェックポイント等で親の状態を壊す恐れがある）。
+    参照を残しておき、ガベージコレクションでクローズされないようにする。
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]):
+        self.connect = connect
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._inherited: List[sqlite3.Connection] = []
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._lock = threading.Lock()
+            self._inherited.extend(self._connections.values())
+            self._connections = {}
+            self._local = threading.local()
+            self._pid = pid
+
+    def get(self) -> sqlite3.Connection:
+        """現在のスレッド用の接続を返す（呼び出し側でcloseしないこと）"""
+        self._check_fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+            with self._lock:
+                self._prune_dead_threads()
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    def _prune_dead_threads(self):
+        # 終了したスレッドの接続を回収（開発サーバーのようにリクエスト毎にスレッドが作られる場合）
+        for thread in [t for t in self._connections if not t.is_alive()]:
+            self._connections.pop(thread).close()
+
+    def close(self):
+        """現在のスレッドの接続をクローズ"""
+        self._check_fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                self._connections.pop(threading.current_thread(), None)
+            conn.close()
+
+    def close_all(self):
+        """このプロセスが開いた全接続をクローズ"""
+        self._check_fork()
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for conn in connections.values():
+            conn.close()
+        self._local = threading.local()
@@ -0,0 +1,147 @@
+import os
+from typing import Dict, Iterable, List, Optional
+
+from cache import LRUCache
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（日本語は1文字≒1トークン、ASCIIは4文字≒1トークン）"""
+    ascii_chars = sum(1 for c in text if c < '\x80')
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def period_label(year: Optional[int], month: Optional[int]) -> str:
+    if year and month:
+        return f"{year}年{month}月"
+    elif year:
+        return f"{year}年"
+    return "全期間"
+
+
+class PromptContextBuilder:
+    """エージェントに渡す工数データのコンテキストを組み立てる
+
+    レコード単位の詳細がトークン予算に収まらない場合は、案件別・メンバー別・月別の
+    集計表に切り替える。組み立て結果は期間とデータバージョンをキーにキャッシュする。
+    """
+
+    def __init__(self, database, analytics, token_budget: Optional[int] = None, cache_entries: int = 32):
+        self.db = database
+        self.analytics = analytics
+        self.token_budget = token_budget or int(os.getenv('KOUSU_AGENT_CONTEXT_TOKENS', '6000'))
+        self.cache = LRUCache(cache_entries)
+
+    def build(self, year: Optional[int] = None, month: Optional[int] = None) -> str:
+        version = self.db.get_data_version()
+        key = (year, month, self.token_budget)
+        found, context = self.cache.get(key, version)
+        if not found:
+            context = self._build(year, month)
+            self.cache.put(key, context, version)
+        return context
+
+    def _build(self, year: Optional[int], month: Optional[int]) -> str:
+        summary = self.db.get_summary_by_period(year, month, include_records=False)
+        header = f"""
+【対象期間】: {period_label(year, month)}
+
+【工数サマリー】:
+- 見積工数合計: {summary['total_estimated']:.1f}時間
+- 予定工数合計: {summary['total_planned']:.1f}時間
+- 実績工数合計: {summary['total_actual']:.1f}時間
+- 案件・レコード数: {summary['record_count']}件
+"""
+        budget = self.token_budget - estimate_tokens(header)
+        parts = [header]
+
+        # 差分は集計表と同じく KousuAnalytics のSQLで計算した値を使う
+        details = self._detail_section(self.analytics.iter_records(year, month), budget)
+        if details is not None:
+            parts.append("\n【詳細データ】:\n")
+            parts.extend(details)
+        else:
+            parts.append("\n※レコード数が多いため、集計データを示します。\n")
+            parts.extend(self._aggregated_sections(year, month, budget))
+        return ''.join(parts)
+
+    @staticmethod
+    def _format_record(record: Dict) -> str:
+        lines = [f"\n案件: {record['project_name']}"]
+        if record['client']:
+            lines.append(f" (クライアント: {record['client']})")
+        lines.append(f"\n  期間: {record['year']}年{record['month']}月")
+        if record.get('member_name'):
+            lines.append(f"\n  担当者: {record['member_name']}")
+        else:
+            lines.append("\n  担当者: 未割当（案件全体）")
+        lines.append(f"\n  見積工数: {record['estimated_hours']:.1f}h")
+        lines.append(f"\n  予定工数: {record['planned_hours']:.1f}h")
+        lines.append(f"\n  実績工数: {record['actual_hours']:.1f}h")
+        lines.append(f"\n  見積差分: {record['estimate_variance']:+.1f}h")
+        lines.append(f"\n  予定差分: {record['plan_variance']:+.1f}h")
+        if record['notes']:
+            lines.append(f"\n  備考: {record['notes']}")
+        lines.append("\n")
+        return ''.join(lines)
+
+    def _detail_section(self, records: Iterable[Dict], budget: int) -> Optional[List[str]]:
+        """レコード単位の詳細。予算を超えた時点でNoneを返す"""
+        parts = []
+        used = 0
+        for record in records:
+            text = self._format_record(record)
+            used += estimate_tokens(text)
+            if used > budget:
+                return None
+            parts.append(text)
+        return parts
+
+    @staticmethod
+    def _table(title: str, columns: List[str], rows: List[List[str]], budget: int) -> str:
+        lines = [f"\n【{title}】:\n", "| " + " | ".join(columns) + " |\n",
+                 "|" + "---|" * len(columns) + "\n"]
+        used = estimate_tokens(''.join(lines))
+        for i, row in enumerate(rows):
+            line = "| " + " | ".join(row) + " |\n"
+            used += estimate_tokens(line)
+            if used > budget:
+                lines.append(f"（残り{len(rows) - i}件は省略）\n")
+                break
+            lines.append(line)
+        return ''.join(lines)
+
+    @staticmethod
+    def _hours(row: Dict) -> List[str]:
+        """KousuAnalytics の行（案件・メンバー・月）の工数・差分・見積精度"""
+        accuracy = row['estimate_accuracy']
+        return [
+            f"{row['estimated_hours']:.1f}",
+            f"{row['planned_hours']:.1f}",
+            f"{row['actual_hours']:.1f}",
+            f"{row['estimate_variance']:+.1f}",
+            f"{row['plan_variance']:+.1f}",
+            f"{accuracy:.0%}" if accuracy is not None else "-",
+        ]
+
+    def _aggregated_sections(self, year: Optional[int], month: Optional[int], budget: int) -> List[str]:
+        hour_columns = ["見積", "予定", "実績", "見積差分", "予定差分", "実績/見積"]
+        # 予算を3つの表で分け合う（実績の大きい順に載せる）
+        share = budget // 3
+
+        # 差分・精度・前月比は /api/analytics と同じ計算結果（期間・データバージョン単位でキャッシュ済み）
+        projects = self.analytics.get('project', year, month)
+        members = self.analytics.get('member', year, month)
+
+        project_rows = [[r['name']] + self._hours(r)
+                        for r in sorted(projects['items'], key=lambda r: r['actual_hours'], reverse=True)]
+        member_rows = [[r['name']] + self._hours(r)
+                       for r in sorted(members['items'], key=lambda r: r['actual_hours'], reverse=True)]
+        month_rows = [[m['month']] + self._hours(m)
+                      + [f"{m['mom_change']:+.1f}" if m['mom_change'] is not None else "-"]
+                      for m in reversed(projects['months'])]
+
+        return [
+            self._table("案件別集計", ["案件"] + hour_columns, project_rows, share),
+            self._table("メンバー別集計", ["メンバー"] + hour_columns, member_rows, share),
+            self._table("月別集計", ["年月"] + hour_columns + ["前月比"], month_rows, share),
+        ]
@@ -1,10 +1,70 @@
 import sqlite3
 import os
+import copy
+import functools
+import inspect
+import logging
 from datetime import datetime
-from typing import List, Dict, Optional
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from cache import LRUCache, estimate_bytes
+from connections import ThreadConnections
+from group_commit import GroupCommitWriter
+from metrics import timed_query
+
+logger = logging.getLogger(__name__)
+
+
+def cached_read(method):
+    """読み取りメソッドの結果をデータバージョン単位でキャッシュする"""
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        version = self.get_data_version()
+        # 位置引数・キーワード引数・既定値の違いで同じ結果を別々に保持しないよう引数を正規化
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (method.__name__,) + tuple(bound.arguments.values())[1:]
+        found, value = self.cache.get(key, version)
+        if not found:
+            value = method(self, *args, **kwargs)
+            self.cache.put(key, value, version)
+        # 呼び出し側でのリスト・辞書の変更がキャッシュに及ばないようにする
+        return copy.copy(value)
+    return wrapper
+
+def period_key(year: int, month: int) -> int:
+    """年月を period 列と同じ整数（year*12+month）に変換"""
+    return year * 12 + month
+
+def parse_period(value: Optional[str], name: str) -> Optional[Tuple[int, int]]:
+    """'YYYY-MM'（または 'YYYY/MM'）を (年, 月) に変換（空ならNone、不正な値はValueError）
+
+    name はエラーメッセージに使う引数名（'from'、'to'）。
+    """
+    if not value:
+        return None
+    try:
+        year, month = (int(part) for part in str(value).replace('/', '-').split('-'))
+    except ValueError:
+        raise ValueError(f'{name}はYYYY-MM形式で指定してください')
+    if not 1 <= month <= 12:
+        raise ValueError(f'{name}の月が不正です')
+    return year, month
 
 class Database:
-    def __init__(self, db_name: str = "kousu.db"):
+    def __init__(self, db_name: str = "kousu.db",
+                 synchronous: Optional[str] = None,
+                 cache_size: Optional[int] = None,
+                 mmap_size: Optional[int] = None,
+                 busy_timeout: Optional[int] = None,
+                 cache_entries: Optional[int] = None,
+                 cache_max_bytes: Optional[int] = None,
+                 group_commit: Optional[bool] = None):
         # Azure App Serviceの永続ストレージ(/home)を使用
         if os.environ.get('WEBSITE_SITE_NAME'):  # Azure環境の判定
             db_dir = '/home/data'
@@ -12,17 +72,96 @@ class Database:
             self.db_name = os.path.join(db_dir, db_name)
         else:
             self.db_name = db_name
+
+        # PRAGMA設定（引数 > 環境変数 > 既定値）
+        self.synchronous = (synchronous or os.getenv('KOUSU_DB_SYNCHRONOUS', 'NORMAL')).upper()
+        if self.synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f"invalid synchronous mode: {self.synchronous}")
+        self.cache_size = cache_size if cache_size is not None else int(os.getenv('KOUSU_DB_CACHE_SIZE', '-20000'))
+        self.mmap_size = mmap_size if mmap_size is not None else int(os.getenv('KOUSU_DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+        self.busy_timeout = busy_timeout if busy_timeout is not None else int(os.getenv('KOUSU_DB_BUSY_TIMEOUT', '5000'))
+
+        # スレッド毎の接続プール（fork後は作り直す）
+        self._connections = ThreadConnections(self._connect)
+
+        # 読み取り結果のキャッシュ（0でキャッシュ無効）
+        # 上限はワーカー毎の推定メモリ量（明細1行でおよそ1KB。既定の32MBで明細3万行程度）
+        cache_entries = cache_entries if cache_entries is not None else int(os.getenv('KOUSU_CACHE_ENTRIES', '256'))
+        cache_max_bytes = cache_max_bytes if cache_max_bytes is not None else int(
+            os.getenv('KOUSU_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+        self.cache = LRUCache(cache_entries, cache_max_bytes, estimate_bytes) if cache_entries > 0 else None
+
+        # 工数の保存は同時に届いたものをまとめてコミットする（KOUSU_GROUP_COMMIT=0で1件ずつ）
+        if group_commit is None:
+            group_commit = os.getenv('KOUSU_GROUP_COMMIT', '1') != '0'
+        self.writer = GroupCommitWriter(self._connect) if group_commit else None
+
         self.init_database()
 
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
+    def _connect(self):
+        # close_all()で他スレッドの接続を閉じられるようcheck_same_thread=False
+        # （各接続はスレッドローカルで1スレッドからのみ使用する）
+        conn = sqlite3.connect(self.db_name, timeout=self.busy_timeout / 1000,
+                               check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
         return conn
 
+    def get_connection(self):
+        """現在のスレッド用の接続を返す（呼び出し側でcloseしないこと）"""
+        return self._connections.get()
+
+    def close(self):
+        """現在のスレッドの接続をクローズ"""
+        self._connections.close()
+
+    def close_all(self):
+        """このプロセスが開いた全接続をクローズ"""
+        if self.writer is not None:
+            self.writer.close()
+        self._connections.close_all()
+
+    # スキーマのマイグレーション（順に適用し、PRAGMA user_version に適用済みの数を記録する）
+    # 既存DBも起動時にその場で更新される。適用済みの手順は変更せず、末尾に追加すること
+    MIGRATIONS = (
+        '_create_base_tables',
+        '_create_rollups',
+        '_create_version_tracking',
+        '_create_query_indexes',
+        '_create_kousu_unique_key',
+        '_create_period_columns',
+        '_create_search_index',
+        '_index_search_entities',
+    )
+
+    def schema_version(self) -> int:
+        return self.get_connection().execute("PRAGMA user_version").fetchone()[0]
+
     def init_database(self):
         conn = self.get_connection()
-        cursor = conn.cursor()
+        if self.schema_version() >= len(self.MIGRATIONS):
+            return
 
+        # 複数ワーカーが同時に起動しても1回だけ適用されるよう、書き込みロックを取ってから再確認
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = self.schema_version()
+            cursor = conn.cursor()
+            for version in range(current + 1, len(self.MIGRATIONS) + 1):
+                name = self.MIGRATIONS[version - 1]
+                logger.info("Applying schema migration %d: %s", version, name)
+                getattr(self, name)(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _create_base_tables(self, cursor):
         # プロジェクトテーブル
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS projects (
@@ -64,225 +203,1014 @@ class Database:
             )
         ''')
 
-        conn.commit()
-        conn.close()
+    def _create_query_indexes(self, cursor):
+        # 期間での絞り込み（DISTINCTでの担当者・案件名の取得、年月一覧はこの索引だけで完結する）
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_kousu_records_period
+            ON kousu_records (year, month, project_id, member_id)
+        ''')
+        # メンバーでの絞り込み・結合
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_kousu_records_member
+            ON kousu_records (member_id, year, month, project_id)
+        ''')
+        # 集計テーブルの主キーは案件/メンバー先頭のため、期間指定用の索引を別に作る
+        for table in self.ROLLUP_TABLES:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_period ON {table} (year, month)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_projects_name ON projects (name)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_projects_created_at ON projects (created_at)")
+        cursor.execute("ANALYZE")
+
+    def _create_kousu_unique_key(self, cursor):
+        # UNIQUE(project_id, member_id, year, month) はNULL同士を別の値とみなすため、
+        # メンバー未割当の行は重複して登録できてしまう。NULLを0に読み替えた式索引で一意にする
+        cursor.execute('''
+            DELETE FROM kousu_records
+            WHERE member_id IS NULL AND id NOT IN (
+                SELECT MAX(id) FROM kousu_records
+                WHERE member_id IS NULL
+                GROUP BY project_id, year, month
+            )
+        ''')
+        if cursor.rowcount:
+            logger.warning("Removed %d duplicate kousu_records without member", cursor.rowcount)
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_kousu_records_key
+            ON kousu_records (project_id, COALESCE(member_id, 0), year, month)
+        ''')
+
+        # 旧版の集計トリガー（INSERT OR IGNORE を使用）を作り直す
+        for event in ('insert', 'delete', 'update'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS kousu_rollup_{event}")
+        self._create_rollup_triggers(cursor)
+
+    def _create_period_columns(self, cursor):
+        # 年月を1つの整数にまとめた生成列。期間の範囲指定（年度・直近12ヶ月等）を1つの索引で引けるようにする
+        for table in ('kousu_records',) + tuple(self.ROLLUP_TABLES):
+            cursor.execute(f'''
+                ALTER TABLE {table}
+                ADD COLUMN period INTEGER GENERATED ALWAYS AS (year * 12 + month) VIRTUAL
+            ''')
+        # 年・月での絞り込みも period の範囲に変換するため、(year, month) の索引は置き換える
+        cursor.execute("DROP INDEX IF EXISTS idx_kousu_records_period")
+        cursor.execute('''
+            CREATE INDEX idx_kousu_records_period
+            ON kousu_records (period, project_id, member_id)
+        ''')
+        for table in self.ROLLUP_TABLES:
+            cursor.execute(f"DROP INDEX IF EXISTS idx_{table}_period")
+            cursor.execute(f"CREATE INDEX idx_{table}_period ON {table} (period)")
+        cursor.execute("ANALYZE")
+
+    # 全文検索（工数レコード1件につき1行。案件・メンバーの名前等も同じ行に持たせる）
+    SEARCH_COLUMNS = ('project_name', 'client', 'description', 'member_name', 'notes')
+    # 2文字の語を引くための列（SEARCH_COLUMNS の各列を2文字ずつに分け、それぞれの後ろに区切り文字を付けたもの）
+    SEARCH_BIGRAM_COLUMNS = tuple(f'{column}_2gram' for column in SEARCH_COLUMNS)
+    SEARCH_BIGRAM_MARK = '\x1f'
+    # bm25の列ごとの重み（SEARCH_COLUMNS、SEARCH_BIGRAM_COLUMNS の順）
+    SEARCH_WEIGHTS = (10.0, 5.0, 2.0, 5.0, 1.0) * 2
+    # 短い語（LIKE）で照合する元の表の列（SEARCH_COLUMNS の順）
+    SEARCH_SOURCES = ('p.name', 'p.client', 'p.description', 'm.name', 'k.notes')
+    # 索引で引ける最短の語長（2文字は SEARCH_BIGRAM_COLUMNS、3文字以上は trigram で照合）
+    SEARCH_MIN_TERM = 2
+    SEARCH_TRIGRAM_TERM = 3
+
+    def _create_search_index(self, cursor):
+        # 日本語は空白で区切られないため trigram（部分一致）で索引を作る（SQLite 3.34以降）
+        # （_index_search_entities で作り直す）
+        columns = 'project_name, client, description, member_name, notes'
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS kousu_search
+            USING fts5({columns}, tokenize = 'trigram')
+        ''')
+        select_sql = '''
+            SELECT k.id, p.name, p.client, p.description, m.name, k.notes
+            FROM kousu_records k
+            JOIN projects p ON p.id = k.project_id
+            LEFT JOIN members m ON m.id = k.member_id
+        '''
+        cursor.execute(f"INSERT INTO kousu_search (rowid, {columns}) {select_sql}")
+
+        # 工数レコードの追加・削除と、検索対象の列が変わった更新だけを反映する
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS kousu_search_insert
+            AFTER INSERT ON kousu_records
+            BEGIN
+                INSERT INTO kousu_search (rowid, {columns}) {select_sql} WHERE k.id = new.id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS kousu_search_delete
+            AFTER DELETE ON kousu_records
+            BEGIN
+                DELETE FROM kousu_search WHERE rowid = old.id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS kousu_search_update
+            AFTER UPDATE ON kousu_records
+            WHEN old.notes IS NOT new.notes
+                OR old.project_id IS NOT new.project_id
+                OR old.member_id IS NOT new.member_id
+            BEGIN
+                DELETE FROM kousu_search WHERE rowid = old.id;
+                INSERT INTO kousu_search (rowid, {columns}) {select_sql} WHERE k.id = new.id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS kousu_search_project_update
+            AFTER UPDATE OF name, client, description ON projects
+            BEGIN
+                UPDATE kousu_search
+                SET project_name = new.name, client = new.client, description = new.description
+                WHERE rowid IN (SELECT id FROM kousu_records WHERE project_id = new.id);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS kousu_search_member_update
+            AFTER UPDATE OF name ON members
+            BEGIN
+                UPDATE kousu_search SET member_name = new.name
+                WHERE rowid IN (SELECT id FROM kousu_records WHERE member_id = new.id);
+            END
+        ''')
+
+    @classmethod
+    def _search_values_sql(cls, project_name: str, client: str, description: str,
+                           member_name: str, notes: str) -> str:
+        """検索索引の1行分の値（SEARCH_COLUMNS と SEARCH_BIGRAM_COLUMNS）のSQL式"""
+        values = (project_name, client, description, member_name, notes)
+        # 長さ-1個の要素のJSON配列を作り、json_each の key を文字の位置として2文字ずつ取り出す
+        # （トリガー内ではWITH句を使えないため）
+        bigrams = [f'''(
+            SELECT group_concat(substr({value}, key + 1, 2) || char(31), '')
+            FROM json_each('[' || rtrim(replace(hex(zeroblob(max(length({value}) - 1, 0))), '00', '0,'), ',') || ']')
+        )''' for value in values]
+        return ', '.join(values + tuple(bigrams))
+
+    def _index_search_entities(self, cursor):
+        # 2文字の語も索引で引けるようにし、工数レコードのない案件・メンバーも単独の行として索引に含める
+        # rowid は工数レコードの行が id、案件の行が -2*id、メンバーの行が -2*id-1
+        for trigger in ('insert', 'delete', 'update', 'project_update', 'member_update'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS kousu_search_{trigger}")
+        cursor.execute("DROP TABLE IF EXISTS kousu_search")
+
+        columns = ', '.join(self.SEARCH_COLUMNS + self.SEARCH_BIGRAM_COLUMNS)
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE kousu_search
+            USING fts5({columns}, tokenize = 'trigram')
+        ''')
+        record_sql = f'''
+            INSERT INTO kousu_search (rowid, {columns})
+            SELECT k.id, {self._search_values_sql('p.name', 'p.client', 'p.description', 'm.name', 'k.notes')}
+            FROM kousu_records k
+            JOIN projects p ON p.id = k.project_id
+            LEFT JOIN members m ON m.id = k.member_id
+        '''
+        project_sql = f'''
+            INSERT INTO kousu_search (rowid, {columns})
+            SELECT -2 * p.id, {self._search_values_sql('p.name', 'p.client', 'p.description', 'NULL', 'NULL')}
+            FROM projects p
+        '''
+        member_sql = f'''
+            INSERT INTO kousu_search (rowid, {columns})
+            SELECT -2 * m.id - 1, {self._search_values_sql('NULL', 'NULL', 'NULL', 'm.name', 'NULL')}
+            FROM members m
+        '''
+        cursor.execute(record_sql)
+        cursor.execute(project_sql)
+        cursor.execute(member_sql)
+
+        # 工数レコードの追加・削除と、検索対象の列が変わった更新だけを反映する
+        cursor.execute(f'''
+            CREATE TRIGGER kousu_search_insert
+            AFTER INSERT ON kousu_records
+            BEGIN
+                {record_sql} WHERE k.id = new.id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER kousu_search_delete
+            AFTER DELETE ON kousu_records
+            BEGIN
+                DELETE FROM kousu_search WHERE rowid = old.id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER kousu_search_update
+            AFTER UPDATE ON kousu_records
+            WHEN old.notes IS NOT new.notes
+                OR old.project_id IS NOT new.project_id
+                OR old.member_id IS NOT new.member_id
+            BEGIN
+                DELETE FROM kousu_search WHERE rowid = old.id;
+                {record_sql} WHERE k.id = new.id;
+            END
+        ''')
+        # 案件・メンバーの変更は、その行と参照している工数レコードの行を作り直す
+        for table, key, watched, entity_sql, rowid in (
+                ('projects', 'project_id', 'name, client, description', project_sql, '-2 * {row}.id'),
+                ('members', 'member_id', 'name', member_sql, '-2 * {row}.id - 1')):
+            alias = table[0]
+            cursor.execute(f'''
+                CREATE TRIGGER kousu_search_{table}_insert
+                AFTER INSERT ON {table}
+                BEGIN
+                    {entity_sql} WHERE {alias}.id = new.id;
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER kousu_search_{table}_delete
+                AFTER DELETE ON {table}
+                BEGIN
+                    DELETE FROM kousu_search WHERE rowid = {rowid.format(row='old')};
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER kousu_search_{table}_update
+                AFTER UPDATE OF {watched} ON {table}
+                BEGIN
+                    DELETE FROM kousu_search WHERE rowid = {rowid.format(row='old')};
+                    {entity_sql} WHERE {alias}.id = new.id;
+                    DELETE FROM kousu_search WHERE rowid IN (SELECT id FROM kousu_records WHERE {key} = new.id);
+                    {record_sql} WHERE k.{key} = new.id;
+                END
+            ''')
+
+    def _create_version_tracking(self, cursor):
+        # 書き込みの度に増えるバージョン番号（全ワーカー共通のキャッシュ無効化に使用）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS data_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)")
+        for table in ('projects', 'members', 'kousu_records'):
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()}
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE data_version SET version = version + 1 WHERE id = 1;
+                    END
+                ''')
+
+    def get_data_version(self) -> int:
+        """データのバージョン番号（いずれかのワーカーが書き込むと増加する）"""
+        row = self.get_connection().execute("SELECT version FROM data_version WHERE id = 1").fetchone()
+        return row[0]
+
+    def cache_stats(self) -> Optional[Dict]:
+        return self.cache.stats() if self.cache is not None else None
+
+    # 月次集計テーブル（kousu_recordsのトリガーで差分更新）
+    ROLLUP_TABLES = {
+        'kousu_project_monthly': 'project_id',
+        'kousu_member_monthly': 'member_key',
+    }
+
+    def _create_rollups(self, cursor):
+        # member_key はメンバー未割当(NULL)を0で表す（主キーにNULLを含めないため）
+        for table, key in self.ROLLUP_TABLES.items():
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {key} INTEGER NOT NULL,
+                    year INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    estimated_hours REAL NOT NULL DEFAULT 0,
+                    planned_hours REAL NOT NULL DEFAULT 0,
+                    actual_hours REAL NOT NULL DEFAULT 0,
+                    record_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY ({key}, year, month)
+                ) WITHOUT ROWID
+            ''')
+
+        self._create_rollup_triggers(cursor)
+
+        # 既存DBに集計テーブルを追加した場合は初回のみ再構築
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM kousu_project_monthly)")
+        has_rollup = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM kousu_records)")
+        has_records = cursor.fetchone()[0]
+        if has_records and not has_rollup:
+            self._fill_rollups(cursor)
+
+    def _create_rollup_triggers(self, cursor):
+        key_exprs = {
+            'kousu_project_monthly': '{row}.project_id',
+            'kousu_member_monthly': 'COALESCE({row}.member_id, 0)',
+        }
+
+        def add_sql(row):
+            sql = ""
+            for table, key in self.ROLLUP_TABLES.items():
+                key_expr = key_exprs[table].format(row=row)
+                # INSERT OR IGNORE は式索引でのUPSERTから呼ばれると外側の競合処理で上書きされるため使わない
+                sql += f'''
+                    INSERT INTO {table} ({key}, year, month)
+                    SELECT {key_expr}, {row}.year, {row}.month
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {table}
+                        WHERE {key} = {key_expr} AND year = {row}.year AND month = {row}.month
+                    );
+                    UPDATE {table} SET
+                        estimated_hours = estimated_hours + {row}.estimated_hours,
+                        planned_hours = planned_hours + {row}.planned_hours,
+                        actual_hours = actual_hours + {row}.actual_hours,
+                        record_count = record_count + 1
+                    WHERE {key} = {key_expr} AND year = {row}.year AND month = {row}.month;
+                '''
+            return sql
+
+        def remove_sql(row):
+            sql = ""
+            for table, key in self.ROLLUP_TABLES.items():
+                key_expr = key_exprs[table].format(row=row)
+                sql += f'''
+                    UPDATE {table} SET
+                        estimated_hours = estimated_hours - {row}.estimated_hours,
+                        planned_hours = planned_hours - {row}.planned_hours,
+                        actual_hours = actual_hours - {row}.actual_hours,
+                        record_count = record_count - 1
+                    WHERE {key} = {key_expr} AND year = {row}.year AND month = {row}.month;
+                    DELETE FROM {table}
+                    WHERE {key} = {key_expr} AND year = {row}.year AND month = {row}.month
+                        AND record_count <= 0;
+                '''
+            return sql
+
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS kousu_rollup_insert AFTER INSERT ON kousu_records
+            BEGIN {add_sql('NEW')} END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS kousu_rollup_delete AFTER DELETE ON kousu_records
+            BEGIN {remove_sql('OLD')} END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS kousu_rollup_update
+            AFTER UPDATE OF project_id, member_id, year, month,
+                estimated_hours, planned_hours, actual_hours ON kousu_records
+            BEGIN {remove_sql('OLD')} {add_sql('NEW')} END
+        ''')
+
+    def _fill_rollups(self, cursor):
+        for table in self.ROLLUP_TABLES:
+            cursor.execute(f"DELETE FROM {table}")
+        cursor.execute('''
+            INSERT INTO kousu_project_monthly
+            (project_id, year, month, estimated_hours, planned_hours, actual_hours, record_count)
+            SELECT project_id, year, month,
+                SUM(estimated_hours), SUM(planned_hours), SUM(actual_hours), COUNT(*)
+            FROM kousu_records
+            GROUP BY project_id, year, month
+        ''')
+        cursor.execute('''
+            INSERT INTO kousu_member_monthly
+            (member_key, year, month, estimated_hours, planned_hours, actual_hours, record_count)
+            SELECT COALESCE(member_id, 0), year, month,
+                SUM(estimated_hours), SUM(planned_hours), SUM(actual_hours), COUNT(*)
+            FROM kousu_records
+            GROUP BY COALESCE(member_id, 0), year, month
+        ''')
+
+    @timed_query
+    def rebuild_rollups(self):
+        """月次集計テーブルをkousu_recordsから再構築"""
+        conn = self.get_connection()
+        with conn:
+            self._fill_rollups(conn.cursor())
 
     # プロジェクト関連
+    @timed_query
     def add_project(self, name: str, client: str = "", description: str = "") -> int:
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO projects (name, client, description) VALUES (?, ?, ?)",
-            (name, client, description)
-        )
-        project_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return project_id
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO projects (name, client, description) VALUES (?, ?, ?)",
+                (name, client, description)
+            )
+        return cursor.lastrowid
 
+    @timed_query
+    @cached_read
     def get_all_projects(self) -> List[Dict]:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM projects ORDER BY created_at DESC")
         projects = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return projects
 
+    @timed_query
+    @cached_read
     def get_project(self, project_id: int) -> Optional[Dict]:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM projects WHERE id = ?", (project_id,))
         row = cursor.fetchone()
-        conn.close()
         return dict(row) if row else None
 
     # メンバー関連
+    @timed_query
     def add_member(self, name: str, email: str = "") -> int:
         conn = self.get_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute(
-                "INSERT INTO members (name, email) VALUES (?, ?)",
-                (name, email)
-            )
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO members (name, email) VALUES (?, ?)",
+                    (name, email)
+                )
             member_id = cursor.lastrowid
-            conn.commit()
         except sqlite3.IntegrityError:
             # 既に存在する場合は既存のIDを返す
-            cursor.execute("SELECT id FROM members WHERE name = ?", (name,))
+            cursor = conn.execute("SELECT id FROM members WHERE name = ?", (name,))
             member_id = cursor.fetchone()[0]
-        finally:
-            conn.close()
         return member_id
 
+    @timed_query
+    @cached_read
     def get_all_members(self) -> List[Dict]:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM members ORDER BY name")
         members = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return members
 
+    @timed_query
+    @cached_read
     def get_member(self, member_id: int) -> Optional[Dict]:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM members WHERE id = ?", (member_id,))
         row = cursor.fetchone()
-        conn.close()
         return dict(row) if row else None
 
     # 工数関連
+    # (project_id, member_id, year, month) が同じ行は更新（メンバー未割当は ux_kousu_records_key で判定）
+    UPSERT_KOUSU_SQL = '''
+        INSERT INTO kousu_records
+        (project_id, member_id, year, month, estimated_hours, planned_hours, actual_hours, notes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(project_id, COALESCE(member_id, 0), year, month) DO UPDATE SET
+            estimated_hours = excluded.estimated_hours,
+            planned_hours = excluded.planned_hours,
+            actual_hours = excluded.actual_hours,
+            notes = excluded.notes,
+            updated_at = CURRENT_TIMESTAMP
+    '''
+
+    @timed_query
     def add_or_update_kousu(self, project_id: int, year: int, month: int,
                            estimated_hours: float = 0, planned_hours: float = 0,
                            actual_hours: float = 0, notes: str = "",
                            member_id: Optional[int] = None) -> bool:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT id FROM kousu_records WHERE project_id = ? AND member_id IS ? AND year = ? AND month = ?",
-            (project_id, member_id, year, month)
-        )
-        existing = cursor.fetchone()
-
-        if existing:
-            cursor.execute('''
-                UPDATE kousu_records
-                SET estimated_hours = ?, planned_hours = ?, actual_hours = ?,
-                    notes = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE project_id = ? AND member_id IS ? AND year = ? AND month = ?
-            ''', (estimated_hours, planned_hours, actual_hours, notes, project_id, member_id, year, month))
+        params = (project_id, member_id, year, month, estimated_hours, planned_hours, actual_hours, notes)
+        if self.writer is not None:
+            # コミットされてから戻る
+            self.writer.execute(self.UPSERT_KOUSU_SQL, params)
         else:
-            cursor.execute('''
-                INSERT INTO kousu_records
-                (project_id, member_id, year, month, estimated_hours, planned_hours, actual_hours, notes)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (project_id, member_id, year, month, estimated_hours, planned_hours, actual_hours, notes))
-
-        conn.commit()
-        conn.close()
+            conn = self.get_connection()
+            with conn:
+                conn.execute(self.UPSERT_KOUSU_SQL, params)
+
         return True
 
-    def get_kousu_by_period(self, year: Optional[int] = None, month: Optional[int] = None) -> List[Dict]:
+    @timed_query
+    def bulk_upsert_kousu(self, rows: Iterable[Dict[str, Any]], chunk_size: int = 1000) -> Dict:
+        """工数レコードを一括登録・更新（1トランザクション）
+
+        各行は project_id または project_name、member_id または member_name（任意）、
+        year, month, estimated_hours, planned_hours, actual_hours, notes を持つ。
+        不正な行はスキップし、errors に行番号（1始まり）とエラー内容を返す。
+        """
         conn = self.get_connection()
-        cursor = conn.cursor()
+        project_ids, project_names = self._project_lookup(conn)
+        member_ids, member_names = self._member_lookup(conn)
+
+        processed = 0
+        errors = []
+        rows_iter = enumerate(rows, start=1)
+        with conn:
+            while True:
+                chunk = list(islice(rows_iter, chunk_size))
+                if not chunk:
+                    break
+
+                # 同一キーは後勝ち（1回のexecutemanyで同じ行を何度も更新しないよう事前に集約）
+                batch: Dict[Tuple, Tuple] = {}
+                for row_number, row in chunk:
+                    try:
+                        values = self._normalize_kousu_row(
+                            row, project_ids, project_names, member_ids, member_names)
+                    except ValueError as e:
+                        errors.append({'row': row_number, 'error': str(e)})
+                        continue
+                    batch[values[:4]] = values
+                    processed += 1
+
+                conn.executemany(self.UPSERT_KOUSU_SQL, batch.values())
+
+        return {'processed': processed, 'error_count': len(errors), 'errors': errors}
 
+    @staticmethod
+    def _project_lookup(conn) -> Tuple[set, Dict[str, Optional[int]]]:
+        ids = set()
+        names: Dict[str, Optional[int]] = {}
+        for row in conn.execute("SELECT id, name FROM projects"):
+            ids.add(row['id'])
+            # 同名案件が複数ある場合は名前では特定できない
+            names[row['name']] = None if row['name'] in names else row['id']
+        return ids, names
+
+    @staticmethod
+    def _member_lookup(conn) -> Tuple[set, Dict[str, int]]:
+        ids = set()
+        names = {}
+        for row in conn.execute("SELECT id, name FROM members"):
+            ids.add(row['id'])
+            names[row['name']] = row['id']
+        return ids, names
+
+    @staticmethod
+    def _normalize_kousu_row(row: Dict[str, Any], project_ids: set, project_names: Dict[str, Optional[int]],
+                             member_ids: set, member_names: Dict[str, int]) -> Tuple:
+        if not isinstance(row, dict):
+            raise ValueError("行の形式が不正です")
+
+        def blank(value):
+            return value is None or (isinstance(value, str) and value.strip() == '')
+
+        def to_int(key):
+            try:
+                return int(row.get(key))
+            except (TypeError, ValueError):
+                raise ValueError(f"{key} が不正です: {row.get(key)!r}")
+
+        def to_float(key):
+            value = row.get(key)
+            if blank(value):
+                return 0.0
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{key} が不正です: {value!r}")
+
+        if not blank(row.get('project_id')):
+            project_id = to_int('project_id')
+            if project_id not in project_ids:
+                raise ValueError(f"案件が見つかりません: {project_id}")
+        elif not blank(row.get('project_name')):
+            name = str(row['project_name']).strip()
+            if name not in project_names:
+                raise ValueError(f"案件が見つかりません: {name}")
+            project_id = project_names[name]
+            if project_id is None:
+                raise ValueError(f"同名の案件が複数あります: {name}")
+        else:
+            raise ValueError("project_id または project_name が必要です")
+
+        if not blank(row.get('member_id')):
+            member_id = to_int('member_id')
+            if member_id not in member_ids:
+                raise ValueError(f"メンバーが見つかりません: {member_id}")
+        elif not blank(row.get('member_name')):
+            name = str(row['member_name']).strip()
+            if name not in member_names:
+                raise ValueError(f"メンバーが見つかりません: {name}")
+            member_id = member_names[name]
+        else:
+            member_id = None
+
+        year = to_int('year')
+        month = to_int('month')
+        if not 1 <= month <= 12:
+            raise ValueError(f"month が不正です: {month}")
+
+        notes = row.get('notes')
+        return (project_id, member_id, year, month,
+                to_float('estimated_hours'), to_float('planned_hours'), to_float('actual_hours'),
+                '' if notes is None else str(notes))
+
+    @timed_query
+    @cached_read
+    def get_kousu_by_period(self, year: Optional[int] = None, month: Optional[int] = None,
+                            after: Optional[Tuple] = None, limit: Optional[int] = None,
+                            period_from: Optional[Tuple[int, int]] = None,
+                            period_to: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        return list(self.iter_kousu_by_period(year, month, after, limit,
+                                              period_from=period_from, period_to=period_to))
+
+    @staticmethod
+    def kousu_sort_key(record: Dict) -> Tuple:
+        """get_kousu_by_period の並び順におけるキー（キーセットページングのカーソル用）"""
+        return (record['year'], record['month'], record['project_name'],
+                record['member_name'] or '', record['id'])
+
+    @timed_query
+    def iter_kousu_by_period(self, year: Optional[int] = None, month: Optional[int] = None,
+                             after: Optional[Tuple] = None, limit: Optional[int] = None,
+                             batch_size: int = 500,
+                             period_from: Optional[Tuple[int, int]] = None,
+                             period_to: Optional[Tuple[int, int]] = None) -> Iterator[Dict]:
+        """工数レコードを1件ずつ返す（全件をメモリに載せない）
+
+        period_from/period_to に (年, 月) を渡すとその範囲（両端を含む）に絞り込む。
+        after に kousu_sort_key() の値を渡すと、その行より後ろから取得する。
+        """
         query = '''
-            SELECT k.*, p.name as project_name, p.client, m.name as member_name
+            SELECT k.id, k.project_id, k.member_id, k.year, k.month,
+                k.estimated_hours, k.planned_hours, k.actual_hours, k.notes,
+                k.created_at, k.updated_at,
+                p.name as project_name, p.client, m.name as member_name
             FROM kousu_records k
             JOIN projects p ON k.project_id = p.id
             LEFT JOIN members m ON k.member_id = m.id
         '''
-        params = []
+        conditions, params = self._period_conditions('k', year, month, period_from, period_to)
+
+        if after is not None:
+            a_year, a_month, a_project, a_member, a_id = after
+            a_period = period_key(a_year, a_month)
+            conditions.append('''(
+                k.period < ?
+                OR (k.period = ? AND (p.name, COALESCE(m.name, ''), k.id) > (?, ?, ?))
+            )''')
+            params.extend([a_period, a_period, a_project, a_member, a_id])
 
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        # メンバー名NULLは''として扱い、同順位はidで一意に並べる
+        query += " ORDER BY k.period DESC, p.name, COALESCE(m.name, ''), k.id"
+
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        yield from self._iter_rows(query, params, batch_size)
+
+    @staticmethod
+    def _period_conditions(alias: str, year: Optional[int], month: Optional[int],
+                           period_from: Optional[Tuple[int, int]] = None,
+                           period_to: Optional[Tuple[int, int]] = None) -> Tuple[List[str], List]:
+        """期間指定を period 列の範囲条件に変換（year/month と from/to を両方指定した場合は重なる範囲）"""
+        lower, upper = [], []
         if year is not None:
-            query += " WHERE k.year = ?"
-            params.append(year)
-            if month is not None:
-                query += " AND k.month = ?"
-                params.append(month)
+            lower.append(period_key(year, month or 1))
+            upper.append(period_key(year, month or 12))
+        if period_from is not None:
+            lower.append(period_key(*period_from))
+        if period_to is not None:
+            upper.append(period_key(*period_to))
 
-        query += " ORDER BY k.year DESC, k.month DESC, p.name, m.name"
+        conditions: List[str] = []
+        params: List[Any] = []
+        if lower and upper and max(lower) == min(upper):
+            conditions.append(f"{alias}.period = ?")
+            params.append(max(lower))
+            return conditions, params
+        if lower:
+            conditions.append(f"{alias}.period >= ?")
+            params.append(max(lower))
+        if upper:
+            conditions.append(f"{alias}.period <= ?")
+            params.append(min(upper))
+        return conditions, params
 
-        cursor.execute(query, params)
-        records = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return records
+    @classmethod
+    def _period_filter(cls, alias: str, year: Optional[int], month: Optional[int],
+                       period_from: Optional[Tuple[int, int]] = None,
+                       period_to: Optional[Tuple[int, int]] = None) -> Tuple[str, List]:
+        conditions, params = cls._period_conditions(alias, year, month, period_from, period_to)
+        if not conditions:
+            return "", []
+        return " WHERE " + " AND ".join(conditions), params
 
-    def get_kousu_by_project(self, year: Optional[int] = None, month: Optional[int] = None) -> List[Dict]:
-        """案件単位で工数を集計"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _iter_rows(self, sql: str, params: Iterable, batch_size: int = 500) -> Iterator[Dict]:
+        """クエリの結果を batch_size 件ずつ読み、1行ずつ辞書で返す"""
+        cursor = self.get_connection().execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
 
-        query = '''
+    @timed_query
+    @cached_read
+    def get_kousu_by_project(self, year: Optional[int] = None, month: Optional[int] = None,
+                             period_from: Optional[Tuple[int, int]] = None,
+                             period_to: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        """案件単位で工数を集計（月次集計テーブルを参照）"""
+        return list(self.iter_kousu_by_project(year, month, period_from, period_to))
+
+    @timed_query
+    def iter_kousu_by_project(self, year: Optional[int] = None, month: Optional[int] = None,
+                              period_from: Optional[Tuple[int, int]] = None,
+                              period_to: Optional[Tuple[int, int]] = None,
+                              batch_size: int = 500) -> Iterator[Dict]:
+        """get_kousu_by_project の結果を1件ずつ返す（エクスポート用）"""
+        where, params = self._period_filter('r', year, month, period_from, period_to)
+        # 担当メンバー名は集計テーブルに持たないため、同じ期間の明細から取得
+        conditions, member_params = self._period_conditions('k', year, month, period_from, period_to)
+        member_filter = ''.join(f" AND {condition}" for condition in conditions)
+
+        yield from self._iter_rows(f'''
             SELECT
-                k.project_id,
+                r.project_id,
                 p.name as project_name,
                 p.client,
-                GROUP_CONCAT(DISTINCT k.year || '年' || k.month || '月') as periods,
-                SUM(k.estimated_hours) as estimated_hours,
-                SUM(k.planned_hours) as planned_hours,
-                SUM(k.actual_hours) as actual_hours,
-                GROUP_CONCAT(DISTINCT m.name) as members
-            FROM kousu_records k
-            JOIN projects p ON k.project_id = p.id
-            LEFT JOIN members m ON k.member_id = m.id
-        '''
-        params = []
+                GROUP_CONCAT(r.year || '年' || r.month || '月') as periods,
+                SUM(r.estimated_hours) as estimated_hours,
+                SUM(r.planned_hours) as planned_hours,
+                SUM(r.actual_hours) as actual_hours,
+                (
+                    SELECT GROUP_CONCAT(DISTINCT m.name)
+                    FROM kousu_records k
+                    JOIN members m ON k.member_id = m.id
+                    WHERE k.project_id = r.project_id{member_filter}
+                ) as members
+            FROM kousu_project_monthly r
+            JOIN projects p ON r.project_id = p.id
+            {where}
+            GROUP BY r.project_id ORDER BY p.name
+        ''', member_params + params, batch_size)
 
-        if year is not None:
-            query += " WHERE k.year = ?"
-            params.append(year)
-            if month is not None:
-                query += " AND k.month = ?"
-                params.append(month)
+    @timed_query
+    @cached_read
+    def get_kousu_by_member(self, year: Optional[int] = None, month: Optional[int] = None,
+                            period_from: Optional[Tuple[int, int]] = None,
+                            period_to: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        """メンバー単位で工数を集計（月次集計テーブルを参照）"""
+        return list(self.iter_kousu_by_member(year, month, period_from, period_to))
 
-        query += " GROUP BY k.project_id ORDER BY p.name"
+    @timed_query
+    def iter_kousu_by_member(self, year: Optional[int] = None, month: Optional[int] = None,
+                             period_from: Optional[Tuple[int, int]] = None,
+                             period_to: Optional[Tuple[int, int]] = None,
+                             batch_size: int = 500) -> Iterator[Dict]:
+        """get_kousu_by_member の結果を1件ずつ返す（エクスポート用）"""
+        where, params = self._period_filter('r', year, month, period_from, period_to)
 
-        cursor.execute(query, params)
-        records = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return records
-
-    def get_kousu_by_member(self, year: Optional[int] = None, month: Optional[int] = None) -> List[Dict]:
-        """メンバー単位で工数を集計"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        query = '''
+        # 担当案件名は集計テーブルに持たないため、同じメンバー・年月の明細から取得
+        yield from self._iter_rows(f'''
             SELECT
-                k.member_id,
+                NULLIF(r.member_key, 0) as member_id,
                 m.name as member_name,
                 m.email,
-                k.year,
-                k.month,
-                SUM(k.estimated_hours) as estimated_hours,
-                SUM(k.planned_hours) as planned_hours,
-                SUM(k.actual_hours) as actual_hours,
-                GROUP_CONCAT(DISTINCT p.name) as projects
-            FROM kousu_records k
-            LEFT JOIN members m ON k.member_id = m.id
-            JOIN projects p ON k.project_id = p.id
-        '''
-        params = []
+                r.year,
+                r.month,
+                r.estimated_hours,
+                r.planned_hours,
+                r.actual_hours,
+                (
+                    SELECT GROUP_CONCAT(DISTINCT p.name)
+                    FROM kousu_records k
+                    JOIN projects p ON k.project_id = p.id
+                    WHERE k.member_id IS NULLIF(r.member_key, 0)
+                        AND k.year = r.year AND k.month = r.month
+                ) as projects
+            FROM kousu_member_monthly r
+            LEFT JOIN members m ON r.member_key = m.id
+            {where}
+            ORDER BY r.year DESC, r.month DESC, m.name
+        ''', params, batch_size)
 
-        if year is not None:
-            query += " WHERE k.year = ?"
-            params.append(year)
-            if month is not None:
-                query += " AND k.month = ?"
-                params.append(month)
+    @timed_query
+    def get_summary_by_period(self, year: Optional[int] = None, month: Optional[int] = None,
+                              include_records: bool = True, after: Optional[Tuple] = None,
+                              limit: Optional[int] = None,
+                              period_from: Optional[Tuple[int, int]] = None,
+                              period_to: Optional[Tuple[int, int]] = None) -> Dict:
+        """期間の合計工数と件数をSQLで集計（include_records=Falseで明細を省略）
+
+        合計と明細はそれぞれ別にキャッシュする（明細を二重にキャッシュしない）。
+        """
+        summary = self.get_period_totals(year, month, period_from, period_to)
+        if include_records:
+            summary['records'] = self.get_kousu_by_period(year, month, after, limit, period_from, period_to)
+        return summary
+
+    @timed_query
+    @cached_read
+    def get_period_totals(self, year: Optional[int] = None, month: Optional[int] = None,
+                          period_from: Optional[Tuple[int, int]] = None,
+                          period_to: Optional[Tuple[int, int]] = None) -> Dict:
+        """期間の見積・予定・実績工数の合計とレコード数"""
+        conn = self.get_connection()
+        where, params = self._period_filter('r', year, month, period_from, period_to)
+        totals = conn.execute(f'''
+            SELECT
+                COALESCE(SUM(r.estimated_hours), 0) as total_estimated,
+                COALESCE(SUM(r.planned_hours), 0) as total_planned,
+                COALESCE(SUM(r.actual_hours), 0) as total_actual,
+                COALESCE(SUM(r.record_count), 0) as record_count
+            FROM kousu_project_monthly r
+            {where}
+        ''', params).fetchone()
+        return dict(totals)
+
+    # 差分（実績 - 比較対象）の比較対象の列
+    VARIANCE_BASES = {'estimated': 'estimated_hours', 'planned': 'planned_hours'}
 
-        query += " GROUP BY k.member_id, k.year, k.month ORDER BY k.year DESC, k.month DESC, m.name"
+    @timed_query
+    @cached_read
+    def get_top_variance(self, group_by: str = 'project', basis: str = 'estimated',
+                         direction: str = 'abs', limit: int = 10,
+                         year: Optional[int] = None, month: Optional[int] = None,
+                         period_from: Optional[Tuple[int, int]] = None,
+                         period_to: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        """期間合計の差分（実績 - 見積 / 実績 - 予定）が大きい案件・メンバーの上位N件
 
-        cursor.execute(query, params)
-        records = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return records
+        direction は 'over'（超過の大きい順）、'under'（不足の大きい順）、'abs'（絶対値の大きい順）。
+        """
+        column = self.VARIANCE_BASES[basis]
+        order = {'over': 'variance DESC', 'under': 'variance ASC', 'abs': 'ABS(variance) DESC'}[direction]
+        having = {'over': 'HAVING variance > 0', 'under': 'HAVING variance < 0', 'abs': ''}[direction]
+        if group_by == 'project':
+            select = "r.project_id, p.name as project_name, p.client"
+            source = "kousu_project_monthly r JOIN projects p ON r.project_id = p.id"
+            key, name = "r.project_id", "p.name"
+        elif group_by == 'member':
+            select = "NULLIF(r.member_key, 0) as member_id, m.name as member_name"
+            source = "kousu_member_monthly r LEFT JOIN members m ON r.member_key = m.id"
+            key, name = "r.member_key", "COALESCE(m.name, '')"
+        else:
+            raise ValueError(f"invalid group_by: {group_by}")
+
+        where, params = self._period_filter('r', year, month, period_from, period_to)
+        cursor = self.get_connection().execute(f'''
+            SELECT {select},
+                SUM(r.estimated_hours) as estimated_hours,
+                SUM(r.planned_hours) as planned_hours,
+                SUM(r.actual_hours) as actual_hours,
+                SUM(r.actual_hours) - SUM(r.{column}) as variance
+            FROM {source}
+            {where}
+            GROUP BY {key}
+            {having}
+            ORDER BY {order}, {name}
+            LIMIT ?
+        ''', params + [limit])
+        return [dict(row) for row in cursor.fetchall()]
 
-    def get_summary_by_period(self, year: Optional[int] = None, month: Optional[int] = None) -> Dict:
-        records = self.get_kousu_by_period(year, month)
+    @timed_query
+    @cached_read
+    def get_dashboard_data(self, year: Optional[int] = None,
+                           period_from: Optional[Tuple[int, int]] = None,
+                           period_to: Optional[Tuple[int, int]] = None) -> Dict:
+        """ダッシュボード用に月別の案件・メンバー・合計工数を集計テーブルから取得（グラフ描画用の形式）"""
+        conn = self.get_connection()
+        where, params = self._period_filter('r', year, None, period_from, period_to)
 
-        total_estimated = sum(r['estimated_hours'] for r in records)
-        total_planned = sum(r['planned_hours'] for r in records)
-        total_actual = sum(r['actual_hours'] for r in records)
+        summary_rows = conn.execute(f'''
+            SELECT r.year, r.month,
+                SUM(r.estimated_hours) as estimated_hours,
+                SUM(r.planned_hours) as planned_hours,
+                SUM(r.actual_hours) as actual_hours
+            FROM kousu_project_monthly r
+            {where}
+            GROUP BY r.year, r.month
+            ORDER BY r.year, r.month
+        ''', params).fetchall()
+
+        months = [f"{r['year']}/{r['month']:02d}" for r in summary_rows]
+        month_index = {(r['year'], r['month']): i for i, r in enumerate(summary_rows)}
+
+        def build_series(rows, key, label):
+            series = {}
+            for r in rows:
+                entry = series.get(r[key])
+                if entry is None:
+                    entry = series[r[key]] = {
+                        'id': r[key],
+                        'name': r[label],
+                        'estimated': [0] * len(months),
+                        'planned': [0] * len(months),
+                        'actual': [0] * len(months),
+                    }
+                i = month_index[(r['year'], r['month'])]
+                entry['estimated'][i] = r['estimated_hours']
+                entry['planned'][i] = r['planned_hours']
+                entry['actual'][i] = r['actual_hours']
+            return list(series.values())
+
+        project_rows = conn.execute(f'''
+            SELECT r.project_id, p.name as project_name, r.year, r.month,
+                r.estimated_hours, r.planned_hours, r.actual_hours
+            FROM kousu_project_monthly r
+            JOIN projects p ON r.project_id = p.id
+            {where}
+            ORDER BY p.name, r.project_id
+        ''', params).fetchall()
+
+        member_rows = conn.execute(f'''
+            SELECT NULLIF(r.member_key, 0) as member_id, COALESCE(m.name, '未割当') as member_name,
+                r.year, r.month, r.estimated_hours, r.planned_hours, r.actual_hours
+            FROM kousu_member_monthly r
+            LEFT JOIN members m ON r.member_key = m.id
+            {where}
+            ORDER BY r.member_key = 0, m.name
+        ''', params).fetchall()
 
         return {
-            'total_estimated': total_estimated,
-            'total_planned': total_planned,
-            'total_actual': total_actual,
-            'record_count': len(records),
-            'records': records
+            'months': months,
+            'projects': build_series(project_rows, 'project_id', 'project_name'),
+            'members': build_series(member_rows, 'member_id', 'member_name'),
+            'summary': {
+                'estimated': [r['estimated_hours'] for r in summary_rows],
+                'planned': [r['planned_hours'] for r in summary_rows],
+                'actual': [r['actual_hours'] for r in summary_rows],
+            }
         }
 
+    @classmethod
+    def _search_conditions(cls, query: str) -> Tuple[Optional[str], List[str], List]:
+        """検索語（空白区切りでAND）を (MATCH式, LIKE条件, LIKEのパラメーター) に変換
+
+        3文字以上の語はFTS5のフレーズ検索、2文字の語は2文字ずつの列に対するフレーズ検索、
+        1文字の語は元の表の各列に対するLIKEにする。
+        """
+        bigram_columns = '{' + ' '.join(cls.SEARCH_BIGRAM_COLUMNS) + '}'
+        phrases, conditions, params = [], [], []
+        for term in query.replace(cls.SEARCH_BIGRAM_MARK, '').split():
+            if len(term) >= cls.SEARCH_TRIGRAM_TERM:
+                phrases.append('"' + term.replace('"', '""') + '"')
+                continue
+            if len(term) >= cls.SEARCH_MIN_TERM:
+                phrases.append(f'{bigram_columns} : "' + term.replace('"', '""') + cls.SEARCH_BIGRAM_MARK + '"')
+                continue
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            conditions.append('(' + ' OR '.join(
+                f"{column} LIKE ? ESCAPE '\\'" for column in cls.SEARCH_SOURCES) + ')')
+            params.extend([pattern] * len(cls.SEARCH_SOURCES))
+        return (' '.join(phrases) or None), conditions, params
+
+    @timed_query
+    @cached_read
+    def search_kousu(self, query: str, year: Optional[int] = None, month: Optional[int] = None,
+                     period_from: Optional[Tuple[int, int]] = None,
+                     period_to: Optional[Tuple[int, int]] = None,
+                     limit: int = 20, offset: int = 0) -> List[Dict]:
+        """案件名・クライアント・案件説明・メンバー名・備考の全文検索
+
+        kind が 'record'（工数レコード）、'project'（案件）、'member'（メンバー）の行を
+        一致度（score、大きいほど上位）の順に返す。案件・メンバーの行は工数レコードがなくても返すが、
+        期間を指定した場合は工数レコードだけを返す。
+        1文字の語だけの検索は索引を使えないため、工数レコードだけを新しい期間順に返す
+        （期間の索引を順に読み、limit件見つかった時点で打ち切る）。
+        """
+        match, conditions, params = self._search_conditions(query)
+        if match is None and not conditions:
+            return []
+        period_conditions, period_params = self._period_conditions('k', year, month, period_from, period_to)
+
+        if match is not None:
+            # 索引で一致した行だけを読み、一致度順に並べる（rowid の符号・偶奇で行の種類を判別）
+            kind = "CASE WHEN s.rowid > 0 THEN 'record' WHEN s.rowid % 2 = 0 THEN 'project' ELSE 'member' END"
+            project_id = "CASE WHEN s.rowid > 0 THEN k.project_id WHEN s.rowid % 2 = 0 THEN -s.rowid / 2 END"
+            member_id = "CASE WHEN s.rowid > 0 THEN k.member_id WHEN s.rowid % 2 = -1 THEN (-s.rowid - 1) / 2 END"
+            source = f'''kousu_search s
+            LEFT JOIN kousu_records k ON s.rowid > 0 AND k.id = s.rowid
+            LEFT JOIN projects p ON p.id = {project_id}
+            LEFT JOIN members m ON m.id = {member_id}'''
+            conditions.insert(0, "s.kousu_search MATCH ?")
+            params.insert(0, match)
+            score = "-bm25(s.kousu_search, " + ', '.join(str(w) for w in self.SEARCH_WEIGHTS) + ")"
+            order = "score DESC, k.period DESC, k.project_id DESC, k.member_id DESC, s.rowid"
+        else:
+            kind, project_id, member_id = "'record'", "k.project_id", "k.member_id"
+            source = '''kousu_records k
+            JOIN projects p ON p.id = k.project_id
+            LEFT JOIN members m ON m.id = k.member_id'''
+            score = "NULL"
+            # 同じ期間内は idx_kousu_records_period の並び（案件・メンバー）で一意に並べる
+            order = "k.period DESC, k.project_id DESC, k.member_id DESC"
+
+        # 期間の条件は工数レコードの列に対するもののため、案件・メンバーの行は除かれる
+        sql = f'''
+            SELECT {kind} AS kind, k.id, {project_id} AS project_id, {member_id} AS member_id,
+                k.year, k.month, k.estimated_hours, k.planned_hours, k.actual_hours, k.notes, k.updated_at,
+                p.name as project_name, p.client, p.description, m.name as member_name,
+                {score} AS score
+            FROM {source}
+            WHERE {' AND '.join(conditions + period_conditions)}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        '''
+        cursor = self.get_connection().execute(sql, params + period_params + [limit, offset])
+        return [dict(row) for row in cursor.fetchall()]
+
+    @timed_query
+    @cached_read
     def get_all_years_months(self) -> List[Dict]:
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT DISTINCT year, month
-            FROM kousu_records
-            ORDER BY year DESC, month DESC
-        ''')
-        periods = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        # period の索引だけで取得し、年月に戻す
+        cursor.execute("SELECT DISTINCT period FROM kousu_records ORDER BY period DESC")
+        periods = []
+        for (period,) in cursor.fetchall():
+            year, month = divmod(period - 1, 12)
+            periods.append({'year': year, 'month': month + 1})
         return periods
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク用の合成データ生成
+シード固定で、案件数・メンバー数・年数を指定してDatabaseに投入する
+
+例: python datagen.py bench.db --projects 500 --members 200 --years 5
+"""
+
+import argparse
+import random
+import time
+from typing import Dict, Iterator
+
+from database import Database
+
+CLIENTS = ['株式会社A', '株式会社B', 'C商事', 'Dシステムズ', 'E製作所', 'F銀行', 'G物流', '社内']
+NOTES = ['', '', '', '仕様変更対応', 'レビュー指摘対応', '障害調査', '追加開発', '打ち合わせ多め']
+
+
+def generate_rows(project_ids, member_ids, start_year: int, years: int,
+                  projects_per_member: int, project_level_ratio: float,
+                  rng: random.Random) -> Iterator[Dict]:
+    """メンバー毎に毎月いくつかの案件へ工数を付けた行を生成"""
+    for year in range(start_year, start_year + years):
+        for month in range(1, 13):
+            for member_id in member_ids:
+                for project_id in rng.sample(project_ids, min(projects_per_member, len(project_ids))):
+                    estimated = rng.randint(0, 80) / 2
+                    yield {
+                        'project_id': project_id,
+                        'member_id': member_id,
+                        'year': year,
+                        'month': month,
+                        'estimated_hours': estimated,
+                        'planned_hours': max(0.0, estimated + rng.randint(-10, 10) / 2),
+                        'actual_hours': max(0.0, estimated + rng.randint(-20, 30) / 2),
+                        'notes': rng.choice(NOTES),
+                    }
+            # 案件全体（メンバー未割当）の見積
+            for project_id in project_ids:
+                if rng.random() < project_level_ratio:
+                    yield {
+                        'project_id': project_id,
+                        'year': year,
+                        'month': month,
+                        'estimated_hours': rng.randint(0, 400) / 2,
+                        'planned_hours': rng.randint(0, 400) / 2,
+                        'actual_hours': 0,
+                    }
+
+
+def populate(db: Database, projects: int = 50, members: int = 20, years: int = 2,
+             start_year: int = 2020, projects_per_member: int = 3,
+             project_level_ratio: float = 0.1, seed: int = 42) -> Dict:
+    """Databaseに合成データを投入し、件数と所要時間を返す"""
+    rng = random.Random(seed)
+    started = time.perf_counter()
+
+    project_ids = [
+        db.add_project(f"案件{i:04d}", rng.choice(CLIENTS), f"ベンチマーク用案件 {i}")
+        for i in range(1, projects + 1)
+    ]
+    member_ids = [
+        db.add_member(f"メンバー{i:04d}", f"member{i:04d}@example.com")
+        for i in range(1, members + 1)
+    ]
+    result = db.bulk_upsert_kousu(generate_rows(
+        project_ids, member_ids, start_year, years, projects_per_member, project_level_ratio, rng))
+
+    return {
+        'projects': projects,
+        'members': members,
+        'years': years,
+        'start_year': start_year,
+        'projects_per_member': projects_per_member,
+        'project_level_ratio': project_level_ratio,
+        'seed': seed,
+        'records': result['processed'],
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--start-year', type=int, default=2020)
+    parser.add_argument('--projects-per-member', type=int, default=3)
+    parser.add_argument('--project-level-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ベンチマーク用の合成データを生成')
+    parser.add_argument('db_path', help='出力先のSQLiteファイル（既存データに追加されます）')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    info = populate(Database(args.db_path), args.projects, args.members, args.years,
+                    args.start_year, args.projects_per_member, args.project_level_ratio, args.seed)
+    print(f"{info['records']}件のレコードを生成しました（{info['seconds']:.1f}秒）")
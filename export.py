@@ -0,0 +1,194 @@
+"""工数データのエクスポート（CSV / XLSX）
+
+行のイテレーター（Databaseの iter_* メソッド）から少しずつ書き出すジェネレーターを返す。
+全件をメモリに載せないため、年間分のような大きなエクスポートでもワーカーのメモリは一定。
+"""
+
+import csv
+import io
+import re
+import zipfile
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+# (キー, 見出し)
+DETAIL_COLUMNS = [
+    ('year', '年'),
+    ('month', '月'),
+    ('project_name', '案件名'),
+    ('client', 'クライアント'),
+    ('member_name', 'メンバー'),
+    ('estimated_hours', '見積工数'),
+    ('planned_hours', '予定工数'),
+    ('actual_hours', '実績工数'),
+    ('notes', '備考'),
+    ('updated_at', '更新日時'),
+]
+
+PROJECT_COLUMNS = [
+    ('project_name', '案件名'),
+    ('client', 'クライアント'),
+    ('periods', '期間'),
+    ('members', 'メンバー'),
+    ('estimated_hours', '見積工数'),
+    ('planned_hours', '予定工数'),
+    ('actual_hours', '実績工数'),
+]
+
+MEMBER_COLUMNS = [
+    ('year', '年'),
+    ('month', '月'),
+    ('member_name', 'メンバー'),
+    ('email', 'メールアドレス'),
+    ('projects', '案件'),
+    ('estimated_hours', '見積工数'),
+    ('planned_hours', '予定工数'),
+    ('actual_hours', '実績工数'),
+]
+
+# 1回に送り出す目安のバイト数
+CHUNK_SIZE = 64 * 1024
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def iter_csv(columns: Sequence[Tuple[str, str]], records: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """CSV（Excelで開けるようBOM付きUTF-8）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    keys = [key for key, _ in columns]
+
+    writer.writerow(label for _, label in columns)
+    first = True
+    for record in records:
+        writer.writerow(record.get(key) for key in keys)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield _drain(buffer, first)
+            first = False
+    yield _drain(buffer, first)
+
+
+def _drain(buffer: io.StringIO, bom: bool) -> bytes:
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return (('\ufeff' if bom else '') + data).encode('utf-8')
+
+
+class _StreamBuffer(io.RawIOBase):
+    """zipfileの書き込み先（書かれたバイト列を溜めておき、ジェネレーターから取り出す）"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self.pending = 0
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.pending += len(data)
+        self._size += len(data)
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.pending = 0
+        return data
+
+    def tell(self):
+        # 書き込み位置のみ返す（seekはできないため、zipfileはデータ記述子付きで書き込む）
+        return self._size
+
+
+# XMLに含められない制御文字
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+_XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _column_letter(index: int) -> str:
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return letters
+
+
+def _xlsx_row(row_number: int, values: Iterable[Any], letters: Sequence[str]) -> str:
+    cells = []
+    for letter, value in zip(letters, values):
+        ref = f'{letter}{row_number}'
+        if value is None or value == '':
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"><v>{value!r}</v></c>')
+        else:
+            text = escape(_INVALID_XML_CHARS.sub('', str(value)))
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row r="{row_number}">{"".join(cells)}</row>'
+
+
+def iter_xlsx(columns: Sequence[Tuple[str, str]], records: Iterable[Dict[str, Any]],
+              sheet_name: str = 'Sheet1') -> Iterator[bytes]:
+    """最小構成のXLSX（スタイル・共有文字列なし、文字列はインラインで書き込む）"""
+    buffer = _StreamBuffer()
+    keys = [key for key, _ in columns]
+    letters = [_column_letter(i) for i in range(len(columns))]
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        archive.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(sheet_name)}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        yield buffer.take()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheetData>'
+                + _xlsx_row(1, (label for _, label in columns), letters)
+            ).encode('utf-8'))
+            for row_number, record in enumerate(records, start=2):
+                sheet.write(_xlsx_row(row_number, (record.get(key) for key in keys), letters).encode('utf-8'))
+                if buffer.pending >= CHUNK_SIZE:
+                    yield buffer.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.take()
@@ -0,0 +1,176 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from metrics import db_write_batch_size, db_write_retries
+
+logger = logging.getLogger(__name__)
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+class GroupCommitWriter:
+    """同時に届いた書き込みを1トランザクションにまとめてコミットする（グループコミット）
+
+    書き込みはプロセスに1つの書き込みスレッドが順に処理する。前のコミット中に届いた書き込みと、
+    flush_interval の間に届いた書き込みを同じトランザクションで実行するため、締め日のような
+    同時保存でもロック取得とfsyncの回数が件数に比例しない。
+    呼び出し元にはコミットが完了してから結果を返す（コミットできなければ例外）。
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection],
+                 flush_interval: Optional[float] = None, max_batch: Optional[int] = None,
+                 retries: Optional[int] = None, synchronous: Optional[str] = None):
+        self.connect = connect
+        # 最初の書き込みを受け取ってから後続を待つ時間（秒）。0でもコミット中に届いた分はまとめる
+        self.flush_interval = (flush_interval if flush_interval is not None
+                               else float(os.getenv('KOUSU_WRITE_FLUSH_MS', '0')) / 1000)
+        self.max_batch = max_batch or int(os.getenv('KOUSU_WRITE_MAX_BATCH', '256'))
+        # 他プロセスがロックを持っている場合の再試行回数（1回毎にbusy_timeoutまで待つ）
+        self.retries = retries if retries is not None else int(os.getenv('KOUSU_WRITE_RETRIES', '5'))
+        # fsyncはまとめた件数で割り勘になるため、既定では電源断にも耐えるFULLでコミットする
+        self.synchronous = (synchronous or os.getenv('KOUSU_WRITE_SYNCHRONOUS', 'FULL')).upper()
+        if self.synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f"invalid synchronous mode: {self.synchronous}")
+
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # fork後は親プロセスの書き込みスレッド・キューを使わない
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._queue = queue.Queue()
+            self._thread = None
+            self._pid = os.getpid()
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """書き込みを依頼してコミットまで待ち、変更行数を返す（SQLの例外はそのまま送出）"""
+        return self.submit(sql, params).result()
+
+    def submit(self, sql: str, params: Sequence[Any] = ()) -> Future:
+        self._check_fork()
+        future: Future = Future()
+        self._queue.put((sql, params, future))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='kousu-writer', daemon=True)
+                self._thread.start()
+        return future
+
+    def close(self):
+        """書き込みスレッドを止める（受け付け済みの書き込みはコミットしてから終了）"""
+        self._check_fork()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        try:
+            conn = self.connect()
+            conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        except Exception as e:
+            logger.exception("Group commit writer could not open the database")
+            # 待っている呼び出し元を止めたままにしない
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    return
+                if item is not None:
+                    item[2].set_exception(e)
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _next_batch(self) -> Optional[List[Tuple]]:
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None:
+                # 停止要求はこのバッチをコミットした後に処理する
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[Tuple]):
+        for attempt in range(self.retries + 1):
+            try:
+                results = self._apply(conn, batch)
+            except sqlite3.OperationalError as e:
+                if _is_busy(e) and attempt < self.retries:
+                    db_write_retries.inc()
+                    logger.warning("Group commit of %d writes is waiting for the database lock (attempt %d): %s",
+                                   len(batch), attempt + 1, e)
+                    time.sleep(min(0.05 * 2 ** attempt, 1.0))
+                    continue
+                logger.error("Group commit of %d writes failed: %s", len(batch), e)
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+            except Exception as e:
+                logger.exception("Group commit of %d writes failed", len(batch))
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+
+            db_write_batch_size.observe(len(batch))
+            for (_, _, future), (error, rowcount) in zip(batch, results):
+                if error is None:
+                    future.set_result(rowcount)
+                else:
+                    future.set_exception(error)
+            return
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, batch: List[Tuple]) -> List[Tuple]:
+        results = []
+        # 書き込みロックを先に取る（取れない場合はbusy_timeoutまで待ってから再試行へ）
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params, _ in batch:
+                try:
+                    results.append((None, conn.execute(sql, params).rowcount))
+                except sqlite3.OperationalError as e:
+                    if _is_busy(e):
+                        raise
+                    results.append((e, None))
+                except sqlite3.Error as e:
+                    # 制約違反等はその文だけが取り消され、他の書き込みはそのままコミットする
+                    results.append((e, None))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return results
@@ -10,21 +10,28 @@ bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
 # ワーカー設定
 # Azure App Serviceのメモリに応じて調整
 workers = int(os.getenv('GUNICORN_WORKERS', '2'))
-worker_class = 'sync'
+# gthread: 1ワーカーで複数リクエストを同時に処理（同時に届いた工数の保存は1回のコミットにまとめる）
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
 worker_connections = 1000
 timeout = 120  # タイムアウトを120秒に設定
 
 # ログ設定
 accesslog = '-'  # 標準出力
 errorlog = '-'   # 標準エラー出力
-loglevel = 'info'
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
 
 # プロセス名
 proc_name = 'kousu_kanri_app'
 
+# アプリケーション（app.create_app）
+wsgi_app = 'app:create_app()'
+
 # 起動前のチェック
-# preload_app = True を無効化してデプロイ時の更新を確実に反映
-preload_app = False
+# マスタープロセスでアプリを1回だけ作成（スキーマ確認もここで1回）し、ワーカーはforkで共有する。
+# DB接続・OpenAIクライアントは各ワーカーがfork後に作成する。GUNICORN_PRELOAD=0 で無効化
+# （preload時はコード更新の反映にワーカーのHUPではなく再起動が必要）
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') != '0'
 
 # セキュリティ設定
 limit_request_line = 4094
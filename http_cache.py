@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from flask import Response, request
+
+# 圧縮対象のContent-Type
+COMPRESSIBLE_TYPES = (
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'text/',
+    'image/svg+xml',
+)
+# これより小さいレスポンスは圧縮しない
+MIN_COMPRESS_SIZE = 500
+GZIP_LEVEL = 6
+
+
+def _build_id() -> str:
+    """アプリのビルド識別子。環境変数 APP_BUILD（未設定ならアプリのPythonモジュールの内容のハッシュ）
+
+    data_version はDBファイルに残るため、デプロイでレスポンスの形式が変わっても
+    古いETagが一致しないようにETagへ混ぜる。
+    """
+    build = os.getenv('APP_BUILD')
+    if build:
+        return build
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.py'):
+            with open(os.path.join(directory, filename), 'rb') as f:
+                digest.update(filename.encode('utf-8') + b'\x00' + f.read())
+    return digest.hexdigest()[:12]
+
+
+BUILD_ID = _build_id()
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1('\x00'.join(str(p) for p in (BUILD_ID,) + parts).encode('utf-8')).hexdigest()
+    return digest[:20]
+
+
+def accepts_gzip() -> bool:
+    return 'gzip' in request.accept_encodings
+
+
+def etag_matches(etag: str) -> bool:
+    """If-None-Match がetag（非圧縮・gzip版のどちらか）と一致するか"""
+    if_none_match = request.if_none_match
+    return (if_none_match.contains(etag)
+            or if_none_match.contains(f'{etag}-gzip')
+            or if_none_match.star_tag)
+
+
+def not_modified(etag: str) -> Response:
+    response = Response(status=304)
+    response.set_etag(f'{etag}-gzip' if accepts_gzip() else etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def compress_response(response: Response) -> Response:
+    """Accept-Encodingにgzipがあればレスポンスを圧縮（ストリーミングは対象外）"""
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or not response.mimetype
+            or not response.mimetype.startswith(COMPRESSIBLE_TYPES)
+            or not accepts_gzip()):
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+
+    response.set_data(gzip.compress(data, GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    # 圧縮版は別表現のため強いETagを分ける
+    etag, weak = response.get_etag()
+    if etag and not weak and not etag.endswith('-gzip'):
+        response.set_etag(f'{etag}-gzip')
+    return response
+
+
+class StaticFileCache:
+    """静的ファイルの内容・gzip版・ETagをメモリに保持（更新時刻とサイズが変わったら読み直す）"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._files: Dict[str, Tuple[Tuple[float, int], bytes, bytes, str]] = {}
+
+    def _load(self, filename: str):
+        path = os.path.join(self.directory, filename)
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            cached = self._files.get(filename)
+            if cached is not None and cached[0] == key:
+                return cached
+        with open(path, 'rb') as f:
+            data = f.read()
+        entry = (key, data, gzip.compress(data, 9), hashlib.sha1(data).hexdigest()[:20])
+        with self._lock:
+            self._files[filename] = entry
+        return entry
+
+    def send(self, filename: str, mimetype: Optional[str] = None) -> Response:
+        _, data, gzipped, etag = self._load(filename)
+        if etag_matches(etag):
+            return not_modified(etag)
+
+        if accepts_gzip():
+            response = Response(gzipped, mimetype=mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(f'{etag}-gzip')
+        else:
+            response = Response(data, mimetype=mimetype)
+            response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        # 毎回ETagで再検証（デプロイ後の更新を即時反映）
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
@@ -0,0 +1,201 @@
+import os
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from connections import ThreadConnections
+
+logger = logging.getLogger(__name__)
+
+# 終了状態
+FINISHED_STATUSES = ('done', 'error', 'cancelled', 'timeout')
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class AgentJobQueue:
+    """エージェント呼び出しをバックグラウンドスレッドで実行するジョブキュー
+
+    ジョブの状態はSQLiteファイルに保存するため、投入したワーカーとは別の
+    gunicornワーカーからも状態・結果を参照・キャンセルできる。
+    実行中は途中までの回答を定期的に書き込み、ポーリングで逐次表示できるようにする。
+    """
+
+    def __init__(self, agent, db_path: str, max_workers: Optional[int] = None,
+                 max_queue: Optional[int] = None, timeout: Optional[float] = None,
+                 retention: Optional[float] = None):
+        self.agent = agent
+        self.db_path = db_path
+        self.max_workers = max_workers or int(os.getenv('KOUSU_AGENT_WORKERS', '2'))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('KOUSU_AGENT_QUEUE', '8'))
+        self.timeout = timeout or float(os.getenv('KOUSU_AGENT_JOB_TIMEOUT', '110'))
+        self.retention = retention or float(os.getenv('KOUSU_AGENT_JOB_RETENTION', '3600'))
+        # 途中経過を書き込む間隔（秒）
+        self.flush_interval = 0.3
+
+        self._lock = threading.Lock()
+        self._connections = ThreadConnections(self._connect)
+        self._executor = None
+        self._pid = os.getpid()
+
+        conn = self._get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS agent_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                message TEXT NOT NULL,
+                year INTEGER,
+                month INTEGER,
+                response TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_agent_jobs_status ON agent_jobs (status, created_at)")
+        conn.commit()
+
+    def _check_fork(self):
+        # fork後は親プロセスのスレッドプールを使わない（接続は ThreadConnections が作り直す）
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._executor = None
+            self._pid = os.getpid()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _get_connection(self):
+        return self._connections.get()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        self._check_fork()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='agent-job')
+            return self._executor
+
+    def _update(self, job_id: str, **fields):
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        conn = self._get_connection()
+        with conn:
+            conn.execute(f"UPDATE agent_jobs SET {columns} WHERE id = ?", list(fields.values()) + [job_id])
+
+    def _finish(self, job_id: str, status: str, **fields):
+        # 既にキャンセル・タイムアウト済みのジョブは上書きしない
+        conn = self._get_connection()
+        columns = ''.join(f", {name} = ?" for name in fields)
+        with conn:
+            conn.execute(
+                f"UPDATE agent_jobs SET status = ?, finished_at = ?{columns} "
+                f"WHERE id = ? AND status NOT IN ({', '.join('?' * len(FINISHED_STATUSES))})",
+                [status, time.time()] + list(fields.values()) + [job_id] + list(FINISHED_STATUSES)
+            )
+
+    def _status(self, job_id: str) -> Optional[str]:
+        row = self._get_connection().execute(
+            "SELECT status FROM agent_jobs WHERE id = ?", (job_id,)).fetchone()
+        return row['status'] if row else None
+
+    def submit(self, message: str, year: Optional[int] = None, month: Optional[int] = None) -> Dict:
+        """ジョブを投入（待ち・実行中のジョブが上限に達している場合はQueueFullError）"""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        conn = self._get_connection()
+        # 件数の確認と投入の間に他のワーカーが投入しないよう、書き込みロックを取ってから数える
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            conn.execute("DELETE FROM agent_jobs WHERE created_at < ?", (now - self.retention,))
+            # 異常終了したワーカーのジョブが残り続けないよう、タイムアウトを過ぎたものは数えない
+            active = conn.execute(
+                "SELECT COUNT(*) FROM agent_jobs WHERE status IN ('queued', 'running') AND created_at > ?",
+                (now - self.timeout,)
+            ).fetchone()[0]
+            if active >= self.max_workers + self.max_queue:
+                raise QueueFullError("エージェントが混み合っています。しばらくしてから再度お試しください。")
+            conn.execute(
+                "INSERT INTO agent_jobs (id, status, message, year, month, created_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, message, year, month, now)
+            )
+
+        self._get_executor().submit(self._run, job_id, message, year, month, now + self.timeout)
+        return self.get(job_id)
+
+    def _run(self, job_id: str, message: str, year: Optional[int], month: Optional[int], deadline: float):
+        if self._status(job_id) != 'queued':
+            return
+        if time.time() > deadline:
+            self._finish(job_id, 'timeout')
+            return
+        self._update(job_id, status='running', started_at=time.time())
+
+        parts = []
+        last_flush = time.time()
+        # 期限はエージェントにも渡し、応答の止まったAPI呼び出しやツールの往復も打ち切る
+        stream = self.agent.chat_stream(message, year, month, deadline=deadline)
+        try:
+            for text in stream:
+                parts.append(text)
+                now = time.time()
+                if now > deadline:
+                    self._finish(job_id, 'timeout', response=''.join(parts))
+                    return
+                if now - last_flush >= self.flush_interval:
+                    if self._status(job_id) != 'running':
+                        return  # キャンセルされた
+                    self._update(job_id, response=''.join(parts))
+                    last_flush = now
+        except TimeoutError:
+            logger.warning("Agent job %s timed out", job_id)
+            self._finish(job_id, 'timeout', response=''.join(parts))
+            return
+        except Exception as e:
+            logger.exception("Agent job %s failed", job_id)
+            self._finish(job_id, 'error', error=str(e), response=''.join(parts))
+            return
+        finally:
+            stream.close()
+
+        self._finish(job_id, 'done', response=''.join(parts))
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._get_connection().execute(
+            "SELECT * FROM agent_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        # 実行していたワーカーが落ちた等で終了しないジョブはタイムアウト扱い
+        if job['status'] not in FINISHED_STATUSES and time.time() > job['created_at'] + self.timeout:
+            self._finish(job_id, 'timeout')
+            job['status'] = 'timeout'
+        job['job_id'] = job.pop('id')
+        return job
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        """待ち・実行中のジョブをキャンセル（実行中のAPI呼び出しは次のトークン受信時に打ち切る）"""
+        if self.get(job_id) is None:
+            return None
+        self._finish(job_id, 'cancelled')
+        return self.get(job_id)
+
+    def stats(self) -> Dict:
+        rows = self._get_connection().execute(
+            "SELECT status, COUNT(*) as count FROM agent_jobs GROUP BY status").fetchall()
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'timeout': self.timeout,
+            'jobs': {row['status']: row['count'] for row in rows},
+        }
@@ -0,0 +1,201 @@
+import functools
+import inspect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# レイテンシ用の既定バケット（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._lock = threading.Lock()
+        # ラベル毎に [バケット別件数..., 合計, 件数]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, data in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, data):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(data[-2])}")
+                lines.append(f"{self.name}_count{labels} {data[-1]}")
+        return lines
+
+
+class Registry:
+    """メトリクスの登録とPrometheusテキスト形式での出力（プロセス単位）"""
+
+    def __init__(self):
+        self._metrics = []
+        # 出力時に値を取得するゲージ（名前, 説明, 値を返す関数）
+        self._gauges: List[Tuple[str, str, Callable[[], Iterable[Tuple[Dict[str, str], float]]]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge_callback(self, name: str, documentation: str,
+                       callback: Callable[[], Iterable[Tuple[Dict[str, str], float]]]):
+        self._gauges.append((name, documentation, callback))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, documentation, callback in self._gauges:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in callback():
+                names = tuple(labels)
+                lines.append(f"{name}{_format_labels(names, [labels[n] for n in names])} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    'kousu_http_request_duration_seconds', 'HTTP request latency by route',
+    ('method', 'route', 'status'))
+db_query_duration = registry.histogram(
+    'kousu_db_query_duration_seconds', 'Database method latency',
+    ('method',))
+db_rows = registry.counter(
+    'kousu_db_rows_total', 'Rows returned by Database methods',
+    ('method',))
+db_errors = registry.counter(
+    'kousu_db_errors_total', 'Exceptions raised by Database methods',
+    ('method',))
+db_write_batch_size = registry.histogram(
+    'kousu_db_write_batch_size', 'Writes committed per group-commit transaction',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+db_write_retries = registry.counter(
+    'kousu_db_write_retries_total', 'Group-commit transactions retried because the database was locked')
+llm_request_duration = registry.histogram(
+    'kousu_llm_request_duration_seconds', 'LLM request latency',
+    ('mode',), buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+llm_tokens = registry.counter(
+    'kousu_llm_tokens_total', 'LLM tokens by type (estimated when the API reports no usage)',
+    ('type', 'source'))
+agent_tool_calls = registry.counter(
+    'kousu_agent_tool_calls_total', 'Agent tool calls by tool and outcome',
+    ('tool', 'status'))
+
+
+def _count_rows(result) -> int:
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        records = result.get('records')
+        return len(records) if isinstance(records, list) else 1
+    return 0 if result is None else 1
+
+
+def timed_query(method):
+    """Databaseメソッドの実行時間と返却行数を記録（ジェネレーターは取り出し時間の合計）"""
+    name = method.__name__
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            elapsed = 0.0
+            rows = 0
+            iterator = method(self, *args, **kwargs)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        row = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    rows += 1
+                    yield row
+            finally:
+                iterator.close()
+                db_query_duration.observe(elapsed, method=name)
+                db_rows.inc(rows, method=name)
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception:
+            db_errors.inc(method=name)
+            raise
+        finally:
+            db_query_duration.observe(time.perf_counter() - start, method=name)
+        db_rows.inc(_count_rows(result), method=name)
+        return result
+    return wrapper
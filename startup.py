@@ -6,10 +6,11 @@ Gunicornを使用してFlaskアプリケーションを起動
 """
 
 import os
-from app import app
+from app import create_app
 
 # Gunicorn用のエクスポート
-# Gunicornは "startup:app" として起動される
+# Gunicornは "startup:app" として起動される（"app:create_app()" でも可）
+app = create_app()
 application = app
 
 if __name__ == "__main__":
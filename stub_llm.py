@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+スクリプト通りに応答するOpenAI互換のスタブモデル（エージェントの動作確認用）
+スクリプトはJSONの配列で、呼び出しごとに先頭から1つずつ返す
+
+    [{"tool_calls": [{"name": "get_top_variance", "arguments": {"group_by": "project", "limit": 3}}]},
+     {"content": "超過の大きい案件は..."}]
+
+プロセス内:   KousuAgent(db, client=ScriptedClient(script))
+HTTPサーバー: python stub_llm.py script.json --port 8001
+              KOUSU_AGENT_BASE_URL=http://127.0.0.1:8001/v1 python app.py
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, Iterator, List
+
+
+class ScriptedModel:
+    """スクリプトの応答を順に返し、受け取ったリクエストを requests に記録する"""
+
+    EXHAUSTED_MESSAGE = "（スタブ: スクリプトの応答は以上です）"
+
+    def __init__(self, script: List[Dict]):
+        self.script = list(script)
+        self.requests: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def _next_step(self, request: Dict) -> Dict:
+        with self._lock:
+            self.requests.append(request)
+            index = len(self.requests) - 1
+        if index < len(self.script):
+            return self.script[index]
+        return {'content': self.EXHAUSTED_MESSAGE}
+
+    @staticmethod
+    def _tool_calls(step: Dict, index: int) -> List[Dict]:
+        return [{
+            'index': i,
+            'id': call.get('id') or f'call_{index}_{i}',
+            'type': 'function',
+            'function': {
+                'name': call['name'],
+                'arguments': call['arguments'] if isinstance(call['arguments'], str)
+                else json.dumps(call['arguments'], ensure_ascii=False),
+            },
+        } for i, call in enumerate(step.get('tool_calls') or ())]
+
+    def complete(self, request: Dict) -> Dict:
+        """chat.completions のレスポンス（JSON）"""
+        step = self._next_step(request)
+        tool_calls = self._tool_calls(step, len(self.requests))
+        message = {'role': 'assistant', 'content': step.get('content')}
+        if tool_calls:
+            message['tool_calls'] = tool_calls
+        return {
+            'id': f'stub-{len(self.requests)}', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': message,
+                         'finish_reason': 'tool_calls' if tool_calls else 'stop'}],
+        }
+
+    def stream(self, request: Dict) -> Iterator[Dict]:
+        """stream=True 時のチャンク（JSON）。本文は数文字ずつ、ツール呼び出しは引数を2つに分けて返す"""
+        step = self._next_step(request)
+        tool_calls = self._tool_calls(step, len(self.requests))
+
+        def chunk(delta, finish_reason=None):
+            return {'id': f'stub-{len(self.requests)}', 'object': 'chat.completion.chunk',
+                    'created': int(time.time()), 'model': request.get('model', 'stub'),
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+        content = step.get('content') or ''
+        for start in range(0, len(content), 8):
+            yield chunk({'content': content[start:start + 8]})
+        for call in tool_calls:
+            arguments = call['function']['arguments']
+            half = len(arguments) // 2
+            yield chunk({'tool_calls': [{'index': call['index'], 'id': call['id'], 'type': 'function',
+                                         'function': {'name': call['function']['name'],
+                                                      'arguments': arguments[:half]}}]})
+            yield chunk({'tool_calls': [{'index': call['index'], 'function': {'arguments': arguments[half:]}}]})
+        yield chunk({}, 'tool_calls' if tool_calls else 'stop')
+
+
+def _namespace(value):
+    """JSONをSDKのレスポンスと同じ属性アクセスにする（無いキーは None）"""
+    if isinstance(value, dict):
+        return _Response(**{key: _namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_namespace(item) for item in value]
+    return value
+
+
+class _Response(SimpleNamespace):
+    def __getattr__(self, name):
+        return None
+
+
+class _Stream:
+    def __init__(self, chunks: Iterator[Dict]):
+        self._chunks = chunks
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield _namespace(chunk)
+
+    def close(self):
+        self._chunks.close()
+
+
+class ScriptedClient:
+    """OpenAIクライアントの代わりに KousuAgent に渡すスタブ（client.chat.completions.create のみ）"""
+
+    def __init__(self, script: List[Dict]):
+        self.model = ScriptedModel(script)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    @property
+    def requests(self) -> List[Dict]:
+        return self.model.requests
+
+    def _create(self, **request):
+        # 後から会話に追加されるメッセージが記録に混ざらないよう複製して保存
+        request = json.loads(json.dumps(request, ensure_ascii=False))
+        if request.get('stream'):
+            return _Stream(self.model.stream(request))
+        return _namespace(self.model.complete(request))
+
+
+def serve(script: List[Dict], host: str = '127.0.0.1', port: int = 8001):
+    model = ScriptedModel(script)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if request.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                for chunk in model.stream(request):
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.write(b"data: [DONE]\n\n")
+                return
+            body = json.dumps(model.complete(request), ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"スタブモデル: http://{host}:{port}/v1 （{len(script)}件の応答）")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='スクリプト通りに応答するOpenAI互換のスタブモデル')
+    parser.add_argument('script', help='応答のJSON配列のファイル')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+
+    with open(args.script, encoding='utf-8') as f:
+        serve(json.load(f), args.host, args.port)
@@ -0,0 +1,112 @@
+"""ツール呼び出しエージェントのテスト（stub_llm.ScriptedClient で応答を固定）
+
+    python -m pytest -q
+"""
+
+import json
+import time
+
+import pytest
+
+from agent import KousuAgent
+from database import Database
+from stub_llm import ScriptedClient
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.delenv('KOUSU_AGENT_CACHE_DB', raising=False)
+    monkeypatch.delenv('KOUSU_AGENT_TOOL_ROUNDS', raising=False)
+    monkeypatch.delenv('KOUSU_AGENT_TOOLS', raising=False)
+    database = Database(str(tmp_path / 'kousu.db'), group_commit=False)
+    project_id = database.add_project('基幹システム刷新', 'A商事')
+    member_id = database.add_member('佐藤')
+    database.add_or_update_kousu(project_id, 2024, 4, 10, 12, 15, '障害対応', member_id)
+    database.add_or_update_kousu(project_id, 2024, 5, 20, 18, 16, '', member_id)
+    yield database
+    database.close_all()
+
+
+def test_tool_round_sends_results_back(db):
+    client = ScriptedClient([
+        {'tool_calls': [
+            {'id': 'call_summary', 'name': 'get_summary', 'arguments': {'from': '2024-04', 'to': '2024-05'}},
+            {'id': 'call_periods', 'name': 'list_periods', 'arguments': {}},
+        ]},
+        {'content': '実績は31時間です。'},
+    ])
+    agent = KousuAgent(db, client=client)
+
+    assert agent.chat('4〜5月の実績は？', 2024) == '実績は31時間です。'
+    assert len(client.requests) == 2
+    assert client.requests[0]['tool_choice'] == 'auto'
+
+    messages = client.requests[1]['messages']
+    assistant = messages[-3]
+    assert assistant['role'] == 'assistant'
+    assert [c['function']['name'] for c in assistant['tool_calls']] == ['get_summary', 'list_periods']
+
+    summary, periods = messages[-2:]
+    assert summary['role'] == 'tool' and summary['tool_call_id'] == 'call_summary'
+    assert json.loads(summary['content']) == {
+        'estimated_hours': 30.0, 'planned_hours': 30.0, 'actual_hours': 31.0, 'record_count': 2,
+    }
+    assert periods['tool_call_id'] == 'call_periods'
+    assert json.loads(periods['content']) == {'rows': ['2024-05', '2024-04']}
+
+
+def test_tool_errors_are_returned_to_the_model(db):
+    client = ScriptedClient([
+        {'tool_calls': [{'name': 'get_summary', 'arguments': {'from': '2024-13'}},
+                        {'name': 'no_such_tool', 'arguments': {}}]},
+        {'content': '期間を確認してください。'},
+    ])
+    agent = KousuAgent(db, client=client)
+
+    assert agent.chat('13月の実績は？') == '期間を確認してください。'
+    invalid, unknown = client.requests[1]['messages'][-2:]
+    assert json.loads(invalid['content']) == {'error': 'fromの月が不正です'}
+    assert 'error' in json.loads(unknown['content'])
+
+
+def test_round_cap_forces_an_answer(db, monkeypatch):
+    monkeypatch.setenv('KOUSU_AGENT_TOOL_ROUNDS', '2')
+    # 毎回ツールを要求し続けるモデル
+    step = {'content': '途中経過', 'tool_calls': [{'name': 'list_periods', 'arguments': {}}]}
+    client = ScriptedClient([step] * 10)
+    agent = KousuAgent(db, client=client)
+
+    assert agent.chat('期間は？') == '途中経過'
+    # 最初の呼び出し + ツールの往復2回で打ち切り、最後はツールなしで回答させる
+    assert len(client.requests) == 3
+    assert [r['tool_choice'] for r in client.requests] == ['auto', 'auto', 'none']
+    assert sum(m['role'] == 'tool' for m in client.requests[-1]['messages']) == 2
+
+
+def test_stream_runs_tool_round(db):
+    client = ScriptedClient([
+        {'tool_calls': [{'id': 'call_search', 'name': 'search_records', 'arguments': {'query': '障害'}}]},
+        {'content': '障害対応は2024年4月に15時間です。'},
+    ])
+    agent = KousuAgent(db, client=client)
+
+    assert ''.join(agent.chat_stream('障害対応の工数は？')) == '障害対応は2024年4月に15時間です。'
+    result = client.requests[1]['messages'][-1]
+    assert result['tool_call_id'] == 'call_search'
+    rows = json.loads(result['content'])['rows']
+    assert [(r['kind'], r.get('period')) for r in rows] == [('record', '2024-04')]
+
+
+def test_deadline_raises_timeout(db):
+    client = ScriptedClient([
+        {'tool_calls': [{'name': 'list_periods', 'arguments': {}}]},
+        {'content': '回答'},
+    ])
+    agent = KousuAgent(db, client=client)
+
+    # 期限切れはエラーメッセージの文字列ではなく TimeoutError として送出する
+    with pytest.raises(TimeoutError):
+        agent.chat('期間は？', deadline=time.time() - 1)
+    with pytest.raises(TimeoutError):
+        list(agent.chat_stream('期間は？', deadline=time.time() - 1))
+    assert client.requests == []
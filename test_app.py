@@ -0,0 +1,70 @@
+"""HTTP APIのテスト（Flaskのテストクライアント）"""
+
+import base64
+import json
+
+import pytest
+
+from app import create_app
+from database import Database
+
+
+def make_cursor(key) -> str:
+    raw = json.dumps(key, ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.delenv('KOUSU_AGENT_JOBS_DB', raising=False)
+    monkeypatch.delenv('KOUSU_AGENT_CACHE_DB', raising=False)
+    database = Database(str(tmp_path / 'kousu.db'), group_commit=False)
+    project_id = database.add_project('基幹システム刷新', 'A商事')
+    member_id = database.add_member('佐藤')
+    for month in range(1, 4):
+        database.add_or_update_kousu(project_id, 2024, month, 10, 10, month, '', member_id)
+        database.add_or_update_kousu(project_id, 2024, month, 5, 5, month, '')
+    app = create_app(database)
+    yield app.test_client()
+    database.close_all()
+
+
+def test_list_pages_with_cursor(client):
+    first = client.get('/api/kousu/list?limit=4').get_json()
+    assert len(first['records']) == 4 and first['next_cursor']
+    second = client.get(f"/api/kousu/list?limit=4&cursor={first['next_cursor']}").get_json()
+    assert len(second['records']) == 2 and second['next_cursor'] is None
+    ids = [r['id'] for r in first['records'] + second['records']]
+    assert len(set(ids)) == 6
+
+
+@pytest.mark.parametrize('key', [
+    [None, None, None, None, None],
+    [[1], 1, 'a', 'b', 1],
+    ['2024', '1', 'a', 'b', 1],
+    [2024, 1, 'a', 'b', True],
+    [2024, True, 'a', 'b', 1],
+    [2024, 1, 1, 'b', 1],
+    [2024, 1, 'a', 'b', 1.5],
+    [2024, 1, 'a', 'b'],
+    {'year': 2024},
+])
+def test_list_rejects_malformed_cursor(client, key):
+    response = client.get(f'/api/kousu/list?limit=2&cursor={make_cursor(key)}')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'cursorが不正です'}
+
+
+@pytest.mark.parametrize('cursor', ['%%%', 'bm90IGpzb24', make_cursor('text')])
+def test_list_rejects_undecodable_cursor(client, cursor):
+    assert client.get(f'/api/kousu/list?limit=2&cursor={cursor}').status_code == 400
+
+
+def test_list_accepts_null_member_in_cursor(client):
+    records = client.get('/api/kousu/list').get_json()
+    # メンバー未割当の行のカーソルは null でも '' と同じ位置から続ける
+    index = next(i for i, r in enumerate(records) if r['member_name'] is None)
+    key = [records[index]['year'], records[index]['month'], records[index]['project_name'], None,
+           records[index]['id']]
+    page = client.get(f'/api/kousu/list?limit=100&cursor={make_cursor(key)}').get_json()
+    assert [r['id'] for r in page['records']] == [r['id'] for r in records[index + 1:]]
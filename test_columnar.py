@@ -0,0 +1,59 @@
+"""列指向JSON形式（format=columnar）のテスト"""
+
+import json
+
+from columnar import decode_columnar, encode_columnar
+from database import Database
+
+
+def round_trip(records, **kwargs):
+    # APIと同じくJSONを経由して戻す
+    payload = json.loads(json.dumps(encode_columnar(records, **kwargs), ensure_ascii=False))
+    return payload, decode_columnar(payload)
+
+
+def test_round_trip_dictionary_columns():
+    records = [
+        {'id': i, 'project_name': f'案件{i % 2}', 'member_name': None if i == 3 else '佐藤',
+         'notes': f'備考{i}', 'actual_hours': i * 1.5}
+        for i in range(6)
+    ]
+    payload, decoded = round_trip(records)
+
+    assert decoded == records
+    assert payload['length'] == 6
+    # 繰り返しの多い文字列の列だけを辞書化する
+    assert set(payload['dictionaries']) == {'project_name', 'member_name'}
+    assert payload['dictionaries']['project_name'] == ['案件0', '案件1']
+    assert payload['values'][payload['columns'].index('member_name')][3] is None
+
+
+def test_round_trip_mixed_and_empty_columns():
+    records = [
+        {'value': 'a', 'empty': None},
+        {'value': 1, 'empty': None},
+        {'value': 'a', 'empty': None},
+    ]
+    payload, decoded = round_trip(records, max_ratio=1.0)
+
+    assert decoded == records
+    assert payload['dictionaries'] == {}
+    assert round_trip([]) == ({'columns': [], 'values': [], 'dictionaries': {}, 'length': 0}, [])
+
+
+def test_round_trip_kousu_records(tmp_path):
+    db = Database(str(tmp_path / 'kousu.db'), group_commit=False)
+    project_ids = [db.add_project(f'案件{i}', 'A商事') for i in range(3)]
+    member_ids = [db.add_member(name) for name in ('佐藤', '鈴木')]
+    for month in range(1, 7):
+        for project_id in project_ids:
+            for member_id in member_ids + [None]:
+                db.add_or_update_kousu(project_id, 2024, month, 8, 7.5, month, '', member_id)
+
+    records = db.get_kousu_by_period(2024)
+    payload, decoded = round_trip(records)
+
+    assert len(records) == 54
+    assert decoded == records
+    assert {'project_name', 'client', 'member_name'} <= set(payload['dictionaries'])
+    db.close_all()